@@ -31,7 +31,9 @@ def _preview_ctx(request):
             "order_count": 0, "file_count": 0, "client_count": 0,
             "version": "preview", "server_version": "preview", "client_recommend": "",
             "o_days": "30", "f_days": "30",
+            "retention_interval": 60, "retention_last_run": "", "retention_last": {},
         },
+        "interval_minutes": "60",
         "rows": [], "files": [], "columns": [],
         "q": "", "page": 1, "pages": 1, "total": 0, "page_size": 100,
         "err": "", "error": "",
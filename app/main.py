@@ -1,20 +1,28 @@
 # app/main.py
-import os, zipfile, re, shutil, time, math, json, traceback, hashlib
-import subprocess, shlex
-from datetime import datetime, timedelta, date
+import os, zipfile, re, shutil, time, math, json, traceback, hashlib, hmac, threading, gzip
+import subprocess, shlex, queue, asyncio, functools, struct
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, date, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from urllib.parse import quote
 from typing import Optional, Iterable
+from contextlib import contextmanager
 
-from fastapi import FastAPI, Request, UploadFile, File, Form, Depends, HTTPException, Query
-from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse, PlainTextResponse, JSONResponse, StreamingResponse
+from fastapi import FastAPI, Request, UploadFile, File, Form, Depends, HTTPException, Query, Body
+from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse, PlainTextResponse, JSONResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from starlette.middleware.sessions import SessionMiddleware
+from starlette.concurrency import run_in_threadpool
 
-from sqlalchemy import create_engine, Column, String, Integer, Boolean, DateTime, Text, select
+from sqlalchemy import create_engine, event, Column, String, Integer, Boolean, DateTime, Text, select, text, insert, literal, func
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.exc import DisconnectionError
 
 from passlib.hash import bcrypt
 import pandas as pd
+import aiofiles
 
 # -------- 基本路径 --------
 BASE_DIR = os.environ.get("HUANDAN_BASE", os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
@@ -23,10 +31,14 @@ DATA_DIR = os.environ.get("HUANDAN_DATA", "/opt/huandan-data")
 PDF_DIR = os.path.join(DATA_DIR, "pdfs")
 UP_DIR  = os.path.join(DATA_DIR, "uploads")
 ZIP_DIR = os.path.join(DATA_DIR, "pdf_zips")  # 每日归档
+BLOB_DIR = os.path.join(DATA_DIR, "pdf_blobs")  # 内容寻址存储：<sha256前2位>/<sha256>.pdf
+PACK_DIR = os.path.join(DATA_DIR, "pdf_packs")  # 冷归档包：每日 ZIP 的只读快照，按偏移直接读取成员
 
 os.makedirs(PDF_DIR, exist_ok=True)
+os.makedirs(BLOB_DIR, exist_ok=True)
 os.makedirs(UP_DIR,  exist_ok=True)
 os.makedirs(ZIP_DIR, exist_ok=True)
+os.makedirs(PACK_DIR, exist_ok=True)
 
 # 确保静态/更新/运行时目录存在
 os.makedirs(os.path.join(BASE_DIR, "app", "static"), exist_ok=True)
@@ -34,6 +46,71 @@ os.makedirs(os.path.join(BASE_DIR, "app", "templates"), exist_ok=True)
 os.makedirs(os.path.join(BASE_DIR, "updates"), exist_ok=True)
 os.makedirs(os.path.join(BASE_DIR, "runtime"), exist_ok=True)
 
+# -------- 多进程协作 --------
+# 多个 uvicorn worker 共用同一数据目录：进程间互斥用 flock 文件锁，缓存失效靠共享内存文件中的计数器
+try:
+    import fcntl, mmap
+except ImportError:  # 非 POSIX 平台只支持单进程
+    fcntl = None
+
+@contextmanager
+def file_lock(path: str, blocking: bool = True):
+    """进程间互斥：blocking=False 时拿不到锁立即 yield False"""
+    if fcntl is None:
+        yield True; return
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False; return
+        yield True
+    finally:
+        os.close(fd)
+
+SHM_PATH = os.path.join(DATA_DIR, ".huandan-shm")
+SHM_MAPPING, SHM_AUTH, SHM_ZIPS, SHM_AUTH_FAILS, SHM_AUTH_LOCKED, SHM_PACKS, SHM_VACUUM = range(7)  # int64 槽位
+_shm = {"fd": None, "map": None, "depth": 0}
+_shm_lock = threading.RLock()
+
+def _shm_open():
+    if _shm["map"] is None and fcntl is not None:
+        fd = os.open(SHM_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(fd).st_size < 4096: os.ftruncate(fd, 4096)
+        _shm["fd"], _shm["map"] = fd, mmap.mmap(fd, 4096)
+    return _shm["map"]
+
+# 无 fcntl 时退化为进程内计数
+_shm_local = [0] * 8
+
+def shm_get(slot: int) -> int:
+    m = _shm_open()
+    return struct.unpack_from("q", m, slot * 8)[0] if m is not None else _shm_local[slot]
+
+@contextmanager
+def shm_locked():
+    """读-改-写共享槽位时持有的锁（进程内线程锁 + 跨进程 flock）"""
+    with _shm_lock:
+        outer = _shm["depth"] == 0  # 可重入：只在最外层加/解 flock
+        m = _shm_open()
+        if m is not None and outer: fcntl.flock(_shm["fd"], fcntl.LOCK_EX)
+        _shm["depth"] += 1
+        try: yield
+        finally:
+            _shm["depth"] -= 1
+            if m is not None and outer: fcntl.flock(_shm["fd"], fcntl.LOCK_UN)
+
+def shm_set(slot: int, value: int):
+    m = _shm_open()
+    if m is not None: struct.pack_into("q", m, slot * 8, int(value))
+    else: _shm_local[slot] = int(value)
+
+def shm_add(slot: int, delta: int = 1) -> int:
+    with shm_locked():
+        v = shm_get(slot) + delta
+        shm_set(slot, v)
+    return v
+
 # -------- 应用/挂载 --------
 app = FastAPI(title="换单服务端")
 app.add_middleware(SessionMiddleware, secret_key=os.environ.get("SECRET_KEY","huandan-secret-key"))
@@ -56,11 +133,58 @@ except Exception:
     pass
 
 # -------- 数据库 --------
+# SQLite 存储配置：HUANDAN_SQLITE_PROFILE 选择预设，单项可用 HUANDAN_SQLITE_<项名大写> 覆盖
+SQLITE_PROFILES = {
+    "balanced": {"journal_mode": "WAL", "synchronous": "NORMAL", "mmap_size": 256*1024*1024,
+                 "cache_size": -64*1024, "busy_timeout": 5000, "temp_store": "MEMORY"},
+    "safe":     {"journal_mode": "WAL", "synchronous": "FULL", "mmap_size": 0,
+                 "cache_size": -16*1024, "busy_timeout": 10000, "temp_store": "DEFAULT"},
+    "legacy":   {"journal_mode": "DELETE", "synchronous": "FULL", "mmap_size": 0,
+                 "cache_size": -2000, "busy_timeout": 5000, "temp_store": "DEFAULT"},
+}
+SQLITE_PROFILE = os.environ.get("HUANDAN_SQLITE_PROFILE", "balanced")
+SQLITE_PRAGMAS = {k: os.environ.get(f"HUANDAN_SQLITE_{k.upper()}", v)
+                  for k, v in SQLITE_PROFILES.get(SQLITE_PROFILE, SQLITE_PROFILES["balanced"]).items()}
+DB_POOL_SIZE = int(os.environ.get("HUANDAN_DB_POOL_SIZE", "8") or "8")
+DB_WRITE_TIMEOUT = int(os.environ.get("HUANDAN_DB_WRITE_TIMEOUT", "600") or "600")
+DB_URL = f"sqlite:///{os.path.join(BASE_DIR,'huandan.sqlite3')}"
+
+def _apply_sqlite_pragmas(dbapi_conn, record):
+    record.info["vacuum_gen"] = shm_get(SHM_VACUUM)
+    cur = dbapi_conn.cursor()
+    try:
+        # busy_timeout 最先设置，后续 PRAGMA（尤其 journal_mode）遇到锁时也会等待
+        for key in ("busy_timeout", "journal_mode", "synchronous", "mmap_size", "cache_size", "temp_store"):
+            cur.execute(f"PRAGMA {key}={SQLITE_PRAGMAS[key]}")
+    finally:
+        cur.close()
+
+# 读连接池：客户端轮询与后台页面并发读取（WAL 下读写互不阻塞）；后台页面的少量增删改（访问码、设置等）
+# 与 last_used 回写也走这里，短事务靠 busy_timeout 等待写锁，不必排在长时间占用写连接的任务后面
 engine = create_engine(
-    f"sqlite:///{os.path.join(BASE_DIR,'huandan.sqlite3')}",
-    connect_args={"check_same_thread": False}
+    DB_URL,
+    connect_args={"check_same_thread": False},
+    poolclass=QueuePool, pool_size=DB_POOL_SIZE, max_overflow=DB_POOL_SIZE,
+)
+# 单写连接：导入/批量删除/对齐/保留期清理在进程内排队，避免与彼此争抢写锁
+write_engine = create_engine(
+    DB_URL,
+    connect_args={"check_same_thread": False},
+    poolclass=QueuePool, pool_size=1, max_overflow=0, pool_timeout=DB_WRITE_TIMEOUT,
 )
+
+def _drop_if_vacuumed(_dbapi_conn, record, _proxy):
+    # 任一进程 VACUUM 之后，此前打开的连接的第一条触发器写入会报 “no such table”；
+    # 整理任务递增 SHM_VACUUM，各进程借出连接时发现代数变化即丢弃该连接，由连接池换新
+    if record.info.get("vacuum_gen") != shm_get(SHM_VACUUM):
+        raise DisconnectionError("database vacuumed")
+
+for _eng in (engine, write_engine):
+    event.listen(_eng, "connect", _apply_sqlite_pragmas)
+    event.listen(_eng, "checkout", _drop_if_vacuumed)
+
 SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+WriteSession = sessionmaker(bind=write_engine, autocommit=False, autoflush=False)
 Base = declarative_base()
 
 class MetaKV(Base):
@@ -80,6 +204,7 @@ class ClientAuth(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     code_hash = Column(String(256))
     code_plain = Column(String(16))
+    code_digest = Column(String(64), index=True)  # HMAC-SHA256(code)，用于索引查找
     description = Column(String(128), default="")
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -91,13 +216,59 @@ class OrderMapping(Base):
     __tablename__ = "order_mapping"
     order_id = Column(String(128), primary_key=True)
     tracking_no = Column(String(128), index=True)
-    updated_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, index=True)
 
 class TrackingFile(Base):
     __tablename__ = "tracking_file"
     tracking_no = Column(String(128), primary_key=True)
     file_path = Column(Text)
-    uploaded_at = Column(DateTime, default=datetime.utcnow)
+    uploaded_at = Column(DateTime, default=datetime.utcnow, index=True)
+    sha256 = Column(String(64), index=True, nullable=True)  # 内容哈希（强 ETag / 去重）
+    # 冷归档后 PDF 内容位于 pack_path 的 [pack_offset, pack_offset+pack_length)，file_path 处的文件已删除；重新导入时清空
+    pack_path = Column(Text, nullable=True)
+    pack_offset = Column(Integer, nullable=True)
+    pack_length = Column(Integer, nullable=True)
+
+class MappingChange(Base):
+    """映射变更日志：version 为空表示尚未发布，set_mapping_version 时统一打上新版本号"""
+    __tablename__ = "mapping_change"
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    version = Column(String(32), index=True, nullable=True)
+    kind = Column(String(8))          # order / file
+    key = Column(String(128))         # order_id 或 tracking_no
+    tracking_no = Column(String(128)) # 变更涉及的运单号（订单改运单时新旧各记一条）
+
+class PdfDay(Base):
+    """按上传日期汇总的 PDF 数量（由 tracking_file 上的触发器增量维护）与当日归档 ZIP 的状态"""
+    __tablename__ = "pdf_day"
+    day = Column(String(10), primary_key=True)  # YYYY-MM-DD（UTC）
+    files = Column(Integer, default=0)
+    rev = Column(Integer, default=0)            # 当日文件每变化一次 +1
+    zip_rev = Column(Integer, nullable=True)    # 当前 ZIP 构建时的 rev；与 rev 不等即 ZIP 已过期
+    zip_size = Column(Integer, nullable=True)
+    zip_sha = Column(String(64), nullable=True)
+
+# 后台任务库：独立的 SQLite 文件，任务进度频繁写入也不会与主库的写连接争锁
+JOB_DB_URL = f"sqlite:///{os.path.join(DATA_DIR, 'jobs.sqlite3')}"
+job_engine = create_engine(JOB_DB_URL, connect_args={"check_same_thread": False})
+event.listen(job_engine, "connect", _apply_sqlite_pragmas)
+JobSession = sessionmaker(bind=job_engine, autocommit=False, autoflush=False)
+JobBase = declarative_base()
+
+class Job(JobBase):
+    __tablename__ = "job"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(String(32), index=True)
+    args = Column(Text)                      # JSON
+    status = Column(String(16), index=True)  # queued / running / done / error
+    progress = Column(Text)                  # 最近一次进度事件（JSON），供页面刷新后重新接入
+    result = Column(Text)                    # 结束事件（JSON）
+    error = Column(Text)
+    attempts = Column(Integer, default=0)
+    owner = Column(String(64))               # 执行者（主机:进程号:启动标识）
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
 
 # -------- 工具函数 --------
 def now_iso(): return datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -114,6 +285,220 @@ def canon_tracking(s: str) -> str:
     s = s.strip("._")
     return s[:128]
 
+def canon_tracking_series(col: "pd.Series") -> "pd.Series":
+    """canon_tracking 的向量化版本（pandas 字符串操作），结果与逐个调用一致"""
+    col = col.fillna("").astype(str).str.strip()
+    col = col.str.replace(r"[^A-Za-z0-9_.-]+", "_", regex=True).str.replace(r"_+", "_", regex=True)
+    return col.str.strip("._").str[:128]
+
+# PDF_DIR 分层：按运单号（小写）的 SHA-1 前缀分 PDF_SHARD_LEVELS 级子目录，每级 2 位十六进制（pdfs/ab/cd/<运单>.pdf）；
+# 0 为旧版平铺布局。旧位置的文件由 pdf_shard_migrate_iter 在线迁移，迁移期间两处均可读取
+PDF_SHARD_LEVELS = max(0, min(4, int(os.environ.get("HUANDAN_PDF_SHARD_LEVELS", "2") or "2")))
+
+def pdf_shard_dir(tracking: str) -> str:
+    h = hashlib.sha1((tracking or "").lower().encode("utf-8")).hexdigest()
+    return os.path.join(PDF_DIR, *[h[i*2:i*2+2] for i in range(PDF_SHARD_LEVELS)])
+
+def pdf_file_path(tracking: str) -> str:
+    """运单号（已规范化）对应的 PDF 落盘路径"""
+    return os.path.join(pdf_shard_dir(tracking), f"{tracking}.pdf")
+
+def pdf_moved_path(fp: str) -> Optional[str]:
+    """登记路径已不存在时（其他进程刚迁移过）按文件名在新/旧两种布局中查找"""
+    name = os.path.basename(fp or "")
+    if not name.endswith(".pdf"): return None
+    for alt in (pdf_file_path(name[:-4]), os.path.join(PDF_DIR, name)):
+        if alt != fp and os.path.exists(alt): return alt
+    return None
+
+def pdf_blob_path(sha: str) -> str:
+    return os.path.join(BLOB_DIR, sha[:2], f"{sha}.pdf")
+
+def _blob_matches(blob: str, data: bytes) -> bool:
+    """已有 blob 的内容与 data 一致（即哈希仍是文件名）。PDF 被外部原地改写时共享 inode 的 blob 跟着变，
+    不能只看文件是否存在就复用"""
+    try:
+        if os.path.getsize(blob) != len(data): return False
+        with open(blob, "rb") as f: return f.read() == data
+    except OSError:
+        return False
+
+def store_pdf_blob(data: bytes, sha: str, target: str):
+    """按内容哈希存一份 blob，再把 target 原子地替换为指向它的硬链接（相同内容只占一份空间）。
+    不支持硬链接的文件系统退化为复制。"""
+    blob = pdf_blob_path(sha)
+    part = f"{target}.{threading.get_ident()}.part"
+    for _ in range(2):
+        if not _blob_matches(blob, data):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            tmp = f"{blob}.{threading.get_ident()}.part"
+            with open(tmp, "wb") as f: f.write(data)
+            os.replace(tmp, blob)
+        try:
+            os.link(blob, part)
+        except FileNotFoundError:
+            continue  # blob 恰好被回收，重写一次
+        except OSError:
+            shutil.copyfile(blob, part)
+        os.replace(part, target)
+        return
+    raise IOError(f"store blob failed: {sha}")
+
+def release_pdf_blob(sha: Optional[str]):
+    """PDF 链接删除/替换后调用：blob 已无其他链接时回收"""
+    if not sha: return
+    blob = pdf_blob_path(sha)
+    try:
+        if os.stat(blob).st_nlink <= 1: os.remove(blob)
+    except Exception:
+        pass
+
+def unlink_pdf(path: Optional[str], sha: Optional[str] = None):
+    try:
+        if path and os.path.exists(path): os.remove(path)
+    except Exception:
+        pass
+    release_pdf_blob(sha)
+
+# 批量删除时文件删除交给后台线程：条目为 (运单, 路径, sha256) 或整个待删目录
+_unlink_queue = queue.Queue()
+
+def _unlink_loop():
+    while True:
+        item = _unlink_queue.get()
+        try:
+            if isinstance(item, str):
+                shutil.rmtree(item, ignore_errors=True)
+            else:
+                tn, path, sha = item
+                cur = _pdf_index["map"].get((tn or "").lower())
+                # 入队后同一运单已被重新导入（路径相同）时只回收 blob，不删新文件
+                unlink_pdf(None if cur and cur[0] == path else path, sha)
+        except Exception as e:
+            print("unlink warn:", e)
+        finally:
+            _unlink_queue.task_done()
+
+def discard_pdf_dirs() -> bool:
+    """全部删除时整体换掉 PDF/blob/冷归档目录：改名后立即建新目录，旧目录交给后台删除；改名失败返回 False"""
+    stamp = datetime.utcnow().strftime("%Y%m%d%H%M%S%f")
+    for d in (PDF_DIR, BLOB_DIR, PACK_DIR):
+        trash = f"{d}.trash-{stamp}"
+        try:
+            os.rename(d, trash)
+        except OSError as e:
+            print("discard dir warn:", e); return False
+        os.makedirs(d, exist_ok=True)
+        _unlink_queue.put(trash)
+    return True
+
+def _queue_stale_trash():
+    for name in os.listdir(DATA_DIR):
+        p = os.path.join(DATA_DIR, name)
+        if ".trash-" in name and os.path.isdir(p): _unlink_queue.put(p)
+
+# 运单号（小写）-> (PDF 路径, sha256, uploaded_at) 的内存索引；启动时由 TrackingFile 构建，导入/删除/对齐时同步维护
+# version 为索引已包含的映射版本：其他 worker 的改动由 get_mapping_version 发现后经 pdf_index_sync 补齐；
+# packed 为已冷归档的运单 -> (包文件, 偏移, 长度)，冷归档任务递增 SHM_PACKS 后各进程重新加载
+# 读取（请求线程）不加锁，只做单次 dict 查找；修改（同步、导入、删除、重载）持 _pdf_index_lock 串行进行，
+# 同步时先查好新值再逐项替换，读者不会看到条目被删后尚未补回的中间状态
+_pdf_index = {"map": {}, "version": "", "packed": {}, "packs_gen": -1}
+_pdf_index_lock = threading.RLock()
+_PDF_INDEX_COLS = (TrackingFile.tracking_no, TrackingFile.file_path, TrackingFile.sha256, TrackingFile.uploaded_at,
+                   TrackingFile.pack_path, TrackingFile.pack_offset, TrackingFile.pack_length)
+
+def pdf_index_reload(db):
+    version = get_kv(db, "mapping_version", "")
+    gen = shm_get(SHM_PACKS)
+    idx, packed = {}, {}
+    for tn, fp, sha, u, pk, off, n in db.execute(select(*_PDF_INDEX_COLS)):
+        if not tn or not fp: continue
+        idx[tn.lower()] = (fp, sha, u)
+        if pk: packed[tn.lower()] = (pk, off, n)
+    with _pdf_index_lock:
+        _pdf_index.update(map=idx, packed=packed, version=version, packs_gen=gen)
+
+def _pdf_packed_reload(db, gen: int):
+    packed = {tn.lower(): (pk, off, n) for tn, pk, off, n in db.execute(text(
+        "SELECT tracking_no, pack_path, pack_offset, pack_length FROM tracking_file WHERE pack_path IS NOT NULL")) if tn}
+    with _pdf_index_lock:
+        _pdf_index.update(packed=packed, packs_gen=gen)
+
+def pdf_index_sync(db, version: str):
+    """按变更日志把 (索引版本, version] 之间的 PDF 改动同步进本进程索引；日志覆盖不到时整体重建。
+    多个请求线程同时发现新版本时只有第一个重放，其余在锁上等到版本已推进后直接返回"""
+    with _pdf_index_lock:
+        since = _pdf_index["version"]
+        if since >= version: return
+        if not since or since < get_kv(db, "mapping_changelog_floor", ""):
+            pdf_index_reload(db); return
+        keys = set(db.execute(select(MappingChange.key).where(
+            MappingChange.kind == "file", MappingChange.version > since, MappingChange.version <= version)).scalars())
+        idx, packed = _pdf_index["map"], _pdf_index["packed"]
+        for part in _chunks(keys):
+            found = {tn.lower(): (fp, sha, u, pk, off, n)
+                     for tn, fp, sha, u, pk, off, n in db.execute(select(*_PDF_INDEX_COLS).where(TrackingFile.tracking_no.in_(part)))
+                     if tn and fp}
+            for k in {(k or "").lower() for k in part}:
+                row = found.get(k)
+                if not row:
+                    idx.pop(k, None); packed.pop(k, None); continue
+                fp, sha, u, pk, off, n = row
+                idx[k] = (fp, sha, u)
+                if pk: packed[k] = (pk, off, n)
+                else: packed.pop(k, None)
+        _pdf_index["version"] = version
+
+def pdf_index_put(items: Iterable, uploaded_at: Optional[datetime] = None):
+    """items 为 (tracking_no, file_path[, sha256]) 序列"""
+    with _pdf_index_lock:
+        idx, packed = _pdf_index["map"], _pdf_index["packed"]
+        for it in items:
+            idx[(it[0] or "").lower()] = (it[1], it[2] if len(it) > 2 else None, uploaded_at)
+            packed.pop((it[0] or "").lower(), None)  # 重新导入后不再走冷归档
+
+def pdf_index_move(moves: Iterable):
+    """moves 为 (tracking_no, 新路径)：只换路径，sha256/uploaded_at 不变"""
+    with _pdf_index_lock:
+        idx = _pdf_index["map"]
+        for tn, fp in moves:
+            ent = idx.get((tn or "").lower())
+            if ent: idx[(tn or "").lower()] = (fp,) + ent[1:]
+
+def pdf_index_drop(trackings: Iterable):
+    with _pdf_index_lock:
+        idx, packed = _pdf_index["map"], _pdf_index["packed"]
+        for tn in trackings:
+            idx.pop((tn or "").lower(), None); packed.pop((tn or "").lower(), None)
+
+def find_pdf_entry(tracking_no: str) -> Optional[tuple]:
+    """按运单号（大小写不敏感，原样或规范化后）查找 (路径, sha256, uploaded_at)；未登记直接返回 None"""
+    idx = _pdf_index["map"]
+    for t in (tracking_no, canon_tracking(tracking_no)):
+        ent = idx.get((t or "").lower())
+        if not ent: continue
+        if os.path.exists(ent[0]): return ent
+        fp = pdf_moved_path(ent[0])
+        if fp: return (fp,) + ent[1:]
+    return None
+
+def find_pdf_packed(tracking_no: str) -> Optional[tuple]:
+    """已冷归档的 PDF：返回 (登记路径, sha256, uploaded_at, (包文件, 偏移, 长度))；find_pdf_entry 未命中时再查"""
+    gen = shm_get(SHM_PACKS)
+    if gen != _pdf_index["packs_gen"]:
+        db = SessionLocal()
+        try: _pdf_packed_reload(db, gen)
+        finally: db.close()
+    for t in (tracking_no, canon_tracking(tracking_no)):
+        k = (t or "").lower()
+        pk, ent = _pdf_index["packed"].get(k), _pdf_index["map"].get(k)
+        if pk and ent and os.path.exists(pk[0]): return ent + (pk,)
+    return None
+
+def read_packed(pk: tuple) -> bytes:
+    with open(pk[0], "rb") as f:
+        return os.pread(f.fileno(), pk[2], pk[1])
+
 def get_db():
     db = SessionLocal()
     try: yield db
@@ -131,16 +516,95 @@ def set_kv(db, key, value):
         obj.value = str(value)
     db.commit()
 
-def set_mapping_version(db): set_kv(db, "mapping_version", now_iso())
+# 进程内记录当前 mapping_version，客户端轮询/304 判断无需查库；
+# gen 对应共享计数 SHM_MAPPING，其他 worker 发布新版本后计数变化，本进程再回库读取
+_mapping_version = {"value": "", "gen": -1}
+
+def set_mapping_version(db):
+    # 计算、写库与计数在同一把跨进程锁内完成，多个 worker 同时发布时版本号仍单调递增
+    with shm_locked():
+        v = now_iso()
+        prev = get_kv(db, "mapping_version", "")
+        if prev and v <= prev:
+            # 同一秒内多次变更：顺延一秒，保证版本号（即 ETag）一定变化
+            try: v = (datetime.strptime(prev, "%Y-%m-%dT%H:%M:%SZ") + timedelta(seconds=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+            except Exception: pass
+        db.execute(text("UPDATE mapping_change SET version=:v WHERE version IS NULL"), {"v": v})
+        set_kv(db, "mapping_version", v)
+        shm_add(SHM_MAPPING)
+    version_watch_kick()
+    # 本进程的 PDF 索引版本不在这里推进：v 可能同时覆盖了其他 worker 已提交、尚未发布的改动，
+    # 由下一次 get_mapping_version 经 pdf_index_sync 按版本区间重放（本进程自己的改动重放一遍无妨）
+    _mapping_version["value"], _mapping_version["gen"] = v, -1
+    _prune_mapping_changelog(db)
+
 def get_mapping_version(db):
+    gen = shm_get(SHM_MAPPING)  # 先读计数再读库：读库期间的新发布会留到下一次
+    v = _mapping_version["value"]
+    if v and gen == _mapping_version["gen"]: return v
     v = get_kv(db, "mapping_version", "")
     if not v:
         set_mapping_version(db); v = get_kv(db,"mapping_version","")
+    if _pdf_index["version"] and _pdf_index["version"] != v: pdf_index_sync(db, v)
+    _mapping_version["value"], _mapping_version["gen"] = v, gen
     return v
 
+# -------- 映射变更日志（增量同步） --------
+CHANGELOG_KEEP_DAYS = int(os.environ.get("HUANDAN_CHANGELOG_DAYS", "7") or "7")
+DELTA_MAX_CHANGES = int(os.environ.get("HUANDAN_DELTA_MAX_CHANGES", "50000") or "50000")
+
+def _chunks(seq, n: int = 500):
+    seq = list(seq)
+    for i in range(0, len(seq), n):
+        yield seq[i:i+n]
+
+def log_mapping_changes(db, kind: str, items: Iterable):
+    """记录变更：items 为 (key, tracking_no) 序列；随调用方的事务一起提交"""
+    rows = [{"kind": kind, "key": k, "tracking_no": t or ""} for k, t in items if k]
+    for part in _chunks(rows, 5000):
+        db.execute(insert(MappingChange.__table__), part)
+
+def log_mapping_changes_from(db, kind: str, key_col, tn_col, *where):
+    """集合式记录变更（INSERT ... SELECT），须在删除数据之前调用"""
+    stmt = select(literal(kind), key_col, tn_col).where(*where)
+    db.execute(insert(MappingChange.__table__).from_select(["kind", "key", "tracking_no"], stmt))
+
+def reset_mapping_changelog(db):
+    """全量清空类操作后调用（在 set_mapping_version 之后）：旧日志作废，更早的客户端回退到全量"""
+    db.execute(text("DELETE FROM mapping_change"))
+    set_kv(db, "mapping_changelog_floor", get_mapping_version(db))
+
+def _prune_mapping_changelog(db):
+    cutoff = (datetime.utcnow() - timedelta(days=CHANGELOG_KEEP_DAYS)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    last = db.execute(text("SELECT MAX(version) FROM mapping_change WHERE version < :c"), {"c": cutoff}).scalar()
+    if not last: return
+    db.execute(text("DELETE FROM mapping_change WHERE version <= :v"), {"v": last})
+    if last > get_kv(db, "mapping_changelog_floor", ""):
+        set_kv(db, "mapping_changelog_floor", last)
+    else:
+        db.commit()
+
+def _ensure_changelog_floor():
+    db = SessionLocal()
+    try:
+        if not get_kv(db, "mapping_changelog_floor", ""):
+            set_kv(db, "mapping_changelog_floor", get_mapping_version(db))
+    finally:
+        db.close()
+
 def _sse(obj: dict) -> str:
     return "data: " + json.dumps(obj, ensure_ascii=False) + "\n\n"
 
+# -------- 重任务线程池 --------
+# 上传文件解析等阻塞工作放到专用的有界线程池，不占用事件循环，也不占用 FastAPI 处理同步接口的默认线程池；
+# 导入/批量删除/对齐/归档重建走下方的持久化任务队列
+HEAVY_WORKERS = int(os.environ.get("HUANDAN_HEAVY_WORKERS", "2") or "2")
+_heavy_pool = ThreadPoolExecutor(max_workers=max(1, HEAVY_WORKERS), thread_name_prefix="heavy")
+
+async def run_heavy(fn, *args):
+    """在重任务线程池中执行阻塞函数并等待结果"""
+    return await asyncio.get_running_loop().run_in_executor(_heavy_pool, functools.partial(fn, *args))
+
 def _safe_join_uploads(name: str) -> str:
     """将上传的临时文件名规范化到 UP_DIR 下，拒绝路径穿越"""
     s = (name or "").replace("\\","/").lstrip("/")
@@ -164,30 +628,279 @@ def _write_sidecar_sha(fp: str, sha: str):
         pass
 
 # -------- 映射写盘 --------
-def _build_mapping_payload(db):
-    map_rows = db.query(OrderMapping).all()
-    file_rows = db.query(TrackingFile).all()
-    tf_by_tn = {f.tracking_no: f for f in file_rows}
-    payload, seen = [], set()
-    for r in map_rows:
-        tn_norm = canon_tracking(r.tracking_no or "")
-        tf = tf_by_tn.get(tn_norm) or tf_by_tn.get(r.tracking_no or "")
-        u = r.updated_at
-        if tf and tf.uploaded_at: u = max([x for x in (u, tf.uploaded_at) if x is not None])
-        payload.append({"order_id": r.order_id, "tracking_no": tn_norm, "updated_at": to_iso(u)})
+def iter_mapping_rows(db):
+    """逐行产出全量映射：先订单行（游标逐行读取，不整体载入），再补无订单的文件行"""
+    tf_by_tn = {tn: u for tn, u in db.execute(select(TrackingFile.tracking_no, TrackingFile.uploaded_at))}
+    seen = set()
+    for oid, tn, u in db.execute(select(OrderMapping.order_id, OrderMapping.tracking_no, OrderMapping.updated_at)):
+        tn_norm = canon_tracking(tn or "")
+        tf_u = tf_by_tn.get(tn_norm) or tf_by_tn.get(tn or "")
+        if tf_u: u = max([x for x in (u, tf_u) if x is not None])
+        yield {"order_id": oid, "tracking_no": tn_norm, "updated_at": to_iso(u)}
         seen.add(tn_norm)
-    for f in file_rows:
-        tn_norm = canon_tracking(f.tracking_no or "")
+    for tn, u in tf_by_tn.items():
+        tn_norm = canon_tracking(tn or "")
         if tn_norm in seen: continue
-        payload.append({"order_id": "", "tracking_no": tn_norm, "updated_at": to_iso(f.uploaded_at)})
-    return {"version": get_mapping_version(db), "mappings": payload}
+        yield {"order_id": "", "tracking_no": tn_norm, "updated_at": to_iso(u)}
+
+def _build_mapping_payload(db):
+    version = get_mapping_version(db)
+    return {"version": version, "mappings": list(iter_mapping_rows(db))}
+
+# 映射快照：每个 mapping_version 只构建一次，缓存编码后的 JSON 及其 gzip 版本
+_mapping_snapshot = {"version": None, "body": b"", "gzip": b""}
+_mapping_snapshot_lock = threading.Lock()
+
+def mapping_snapshot(db) -> dict:
+    version = get_mapping_version(db)
+    snap = _mapping_snapshot
+    if snap["version"] == version: return snap
+    with _mapping_snapshot_lock:
+        snap = _mapping_snapshot
+        if snap["version"] == version: return snap
+        data = _build_mapping_payload(db)
+        body = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        snap = {"version": data["version"], "body": body, "gzip": gzip.compress(body, compresslevel=6)}
+        _mapping_snapshot.update(snap)
+        return snap
+
+def _build_mapping_delta(db, since: str, version: str) -> Optional[dict]:
+    """返回 since 之后（不含）到 version 为止的增量；日志不足以覆盖时返回 None（回退全量）。
+    upserts 与全量 mappings 同格式；deleted 中 order_id 非空按订单删除，否则按运单删除无订单的文件行。"""
+    floor = get_kv(db, "mapping_changelog_floor", "")
+    if not since or not floor or since < floor or since > version: return None
+    n = db.execute(select(func.count()).select_from(MappingChange).where(
+        MappingChange.version > since, MappingChange.version <= version)).scalar() or 0
+    if n > DELTA_MAX_CHANGES: return None
+    changes = db.execute(select(MappingChange.kind, MappingChange.key, MappingChange.tracking_no).where(
+        MappingChange.version > since, MappingChange.version <= version)).all()
+    order_ids = {k for kind, k, _ in changes if kind == "order"}
+    tns = {canon_tracking(t) for _, _, t in changes if t} | {canon_tracking(k) for kind, k, _ in changes if kind == "file"}
+    tns.discard("")
+
+    orders = {}
+    for part in _chunks(order_ids):
+        for oid, tn, u in db.execute(select(OrderMapping.order_id, OrderMapping.tracking_no, OrderMapping.updated_at).where(OrderMapping.order_id.in_(part))):
+            orders[oid] = (tn, u)
+    referenced = set()
+    files = {}
+    for part in _chunks(tns):
+        for oid, tn, u in db.execute(select(OrderMapping.order_id, OrderMapping.tracking_no, OrderMapping.updated_at).where(OrderMapping.tracking_no.in_(part))):
+            orders[oid] = (tn, u); referenced.add(tn)
+        for tn, u in db.execute(select(TrackingFile.tracking_no, TrackingFile.uploaded_at).where(TrackingFile.tracking_no.in_(part))):
+            files[tn] = u
+    extra_tns = {canon_tracking(tn or "") for tn, _ in orders.values()} - set(files)
+    for part in _chunks(extra_tns):
+        for tn, u in db.execute(select(TrackingFile.tracking_no, TrackingFile.uploaded_at).where(TrackingFile.tracking_no.in_(part))):
+            files[tn] = u
+
+    upserts, deleted = [], []
+    for oid, (tn, u) in orders.items():
+        tn_norm = canon_tracking(tn or "")
+        tf_u = files.get(tn_norm) or files.get(tn or "")
+        if tf_u: u = max([x for x in (u, tf_u) if x is not None])
+        upserts.append({"order_id": oid, "tracking_no": tn_norm, "updated_at": to_iso(u)})
+    for oid in order_ids - set(orders):
+        deleted.append({"order_id": oid, "tracking_no": ""})
+    for tn in sorted(tns):
+        if tn in files and tn not in referenced:
+            upserts.append({"order_id": "", "tracking_no": tn, "updated_at": to_iso(files[tn])})
+        else:
+            deleted.append({"order_id": "", "tracking_no": tn})
+    return {"version": version, "since": since, "mode": "delta", "upserts": upserts, "deleted": deleted}
+
+_mapping_delta_cache = {"version": None, "items": {}}
+
+def mapping_delta(db, since: str) -> Optional[bytes]:
+    """同一版本下相同 since 的增量只计算一次"""
+    version = get_mapping_version(db)
+    cache = _mapping_delta_cache
+    if cache["version"] != version:
+        cache = {"version": version, "items": {}}
+        _mapping_delta_cache.update(cache)
+    if since in cache["items"]: return cache["items"][since]
+    data = _build_mapping_delta(db, since, version)
+    body = None if data is None else json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if len(cache["items"]) >= 64: cache["items"].clear()
+    cache["items"][since] = body
+    return body
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    inm = request.headers.get("if-none-match")
+    if not inm: return False
+    tags = [t.strip() for t in inm.split(",")]
+    return "*" in tags or any(t == etag or t == "W/" + etag for t in tags)
+
+def _not_modified_since(request: Request, last_modified: datetime) -> bool:
+    ims = request.headers.get("if-modified-since")
+    if not ims or request.headers.get("if-none-match"): return False
+    try:
+        return int(last_modified.replace(tzinfo=timezone.utc).timestamp()) <= int(parsedate_to_datetime(ims).timestamp())
+    except Exception:
+        return False
+
+def pdf_file_response(request: Request, tracking_no: str, db):
+    """单个 PDF 下载：强 ETag（内容哈希，缺失时用上传时间+大小）、Last-Modified、304，
+    Range/If-Range 由 FileResponse 处理，断点续传无需重新下载整份文件"""
+    get_mapping_version(db)  # 先同步其他 worker 的改动到本进程索引
+    ent = find_pdf_entry(tracking_no) or find_pdf_packed(tracking_no)
+    if not ent: raise HTTPException(status_code=404, detail="file not found")
+    fp, sha, uploaded_at = ent[:3]
+    pk = ent[3] if len(ent) > 3 else None
+    if pk:
+        st = os.stat(pk[0]); size = pk[2]
+    else:
+        st = os.stat(fp); size = st.st_size
+    lm = uploaded_at or datetime.utcfromtimestamp(st.st_mtime)
+    etag = f'"{sha}"' if sha else f'"{int(lm.replace(tzinfo=timezone.utc).timestamp())}-{size}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(lm.replace(tzinfo=timezone.utc), usegmt=True),
+        "Cache-Control": "private, no-cache",
+    }
+    if _etag_matches(request, etag) or _not_modified_since(request, lm):
+        return Response(status_code=304, headers=headers)
+    if pk: return packed_pdf_response(request, pk, os.path.basename(fp), headers)
+    return send_data_file(fp, "application/pdf", headers, st)
+
+# 文件发送卸载：HUANDAN_FILE_OFFLOAD=x-accel（nginx）/ x-sendfile（Apache mod_xsendfile、lighttpd）时，
+# 鉴权、ETag/304、sha256 头仍由应用处理，响应体为空，只带内部重定向头，由前置代理直接发送文件（含 Range）；
+# 默认空值为直接发送。冷归档中的 PDF 是包内一段，始终直接发送。示例配置见 deploy/nginx-huandan.conf
+FILE_OFFLOAD = os.environ.get("HUANDAN_FILE_OFFLOAD", "").strip().lower()
+FILE_OFFLOAD_PREFIX = os.environ.get("HUANDAN_FILE_OFFLOAD_PREFIX", "/_huandan_data/")
+if FILE_OFFLOAD not in ("", "x-accel", "x-sendfile"):
+    print("unknown HUANDAN_FILE_OFFLOAD, serving files directly:", FILE_OFFLOAD); FILE_OFFLOAD = ""
+
+def send_data_file(fp: str, media_type: str, headers: dict, stat_result=None) -> Response:
+    """发送 DATA_DIR 下的文件：开启卸载时返回内部重定向，否则 FileResponse"""
+    if not FILE_OFFLOAD or not fp.startswith(DATA_DIR + os.sep):
+        return FileResponse(fp, media_type=media_type, filename=os.path.basename(fp), headers=headers, stat_result=stat_result)
+    name = os.path.basename(fp)
+    h = dict(headers)
+    h["Content-Disposition"] = (f'attachment; filename="{name}"' if quote(name) == name
+                                else f"attachment; filename*=utf-8''{quote(name)}")
+    if FILE_OFFLOAD == "x-accel":
+        h["X-Accel-Redirect"] = FILE_OFFLOAD_PREFIX.rstrip("/") + "/" + quote(os.path.relpath(fp, DATA_DIR).replace(os.sep, "/"))
+    else:
+        h["X-Sendfile"] = fp
+    return Response(media_type=media_type, headers=h)
 
-def write_mapping_json(db):
-    data = _build_mapping_payload(db)
-    fp = os.path.join(DATA_DIR, "mapping.json")
-    os.makedirs(os.path.dirname(fp), exist_ok=True)
-    with open(fp, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+PACK_READ_CHUNK = 256 * 1024
+
+def _parse_range(header: str, size: int) -> Optional[tuple]:
+    """只支持单段 bytes=a-b / a- / -n；无法满足时返回 (size, size)"""
+    m = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", header or "")
+    if not m or not (m.group(1) or m.group(2)): return None
+    if m.group(1):
+        start = int(m.group(1)); end = min(int(m.group(2)) if m.group(2) else size - 1, size - 1)
+    else:
+        start = max(0, size - int(m.group(2))); end = size - 1
+    return (start, end) if start <= end else (size, size)
+
+def packed_pdf_response(request: Request, pk: tuple, filename: str, headers: dict) -> Response:
+    """从冷归档包按偏移读出单个 PDF（pread 分块，不解压、不落临时文件）；支持单段 Range/If-Range"""
+    path, offset, size = pk
+    start, end, status = 0, size - 1, 200
+    rng = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if rng and (not if_range or if_range == headers.get("ETag") or if_range == headers.get("Last-Modified")):
+        r = _parse_range(rng, size)
+        if r and r[0] >= size:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+        if r:
+            start, end, status = r[0], r[1], 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    def _body():
+        with open(path, "rb") as f:
+            pos, left = offset + start, end - start + 1
+            while left > 0:
+                buf = os.pread(f.fileno(), min(PACK_READ_CHUNK, left), pos)
+                if not buf: break
+                pos += len(buf); left -= len(buf)
+                yield buf
+    headers.update({"Content-Length": str(end - start + 1), "Accept-Ranges": "bytes",
+                    "Content-Disposition": f'attachment; filename="{filename}"'})
+    return StreamingResponse(_body(), status_code=status, media_type="application/pdf", headers=headers)
+
+# mapping.json：流式写临时文件后原子改名，附带压缩副本（gzip，或安装 zstandard 后可选 zstd）与 .sha256 sidecar；
+# 管理操作只登记写盘请求，后台线程在 DEBOUNCE 秒内无新请求后统一写一次
+MAPPING_JSON = os.path.join(DATA_DIR, "mapping.json")
+MAPPING_COMPRESS = (os.environ.get("HUANDAN_MAPPING_COMPRESS", "gzip") or "none").lower()  # gzip / zstd / none
+MAPPING_WRITE_DEBOUNCE = float(os.environ.get("HUANDAN_MAPPING_DEBOUNCE", "2") or "0")
+MAPPING_WRITE_MAX_DELAY = max(MAPPING_WRITE_DEBOUNCE * 10, 5.0)  # 持续变更时最长推迟时间
+MAPPING_ENCODE_CHUNK = 5000
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_mapping_file_lock = threading.Lock()
+_mapping_writer = {"running": False, "first": None, "due": 0.0}
+_mapping_write_wake = threading.Event()
+
+def _mapping_compressor(raw):
+    """返回 (扩展名, 压缩流)；未启用压缩时为 (None, None)，要求 zstd 但未安装 zstandard 时回退 gzip"""
+    if MAPPING_COMPRESS == "none": return None, None
+    if MAPPING_COMPRESS == "zstd" and zstandard is not None:
+        return ".zst", zstandard.ZstdCompressor(level=6).stream_writer(raw, closefd=False)
+    return ".gz", gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6, mtime=0)
+
+def write_mapping_file() -> str:
+    """立即写出 mapping.json 并返回其 SHA-256"""
+    with _mapping_file_lock, file_lock(MAPPING_JSON + ".lock"):
+        db = SessionLocal()
+        try:
+            tmp = MAPPING_JSON + ".tmp"
+            ext = None
+            with open(tmp, "wb") as raw, open(tmp + ".z", "wb") as zraw:
+                out = _HashingWriter(raw)
+                ext, z = _mapping_compressor(zraw)
+                def w(b):
+                    out.write(b)
+                    if z: z.write(b)
+                w(b'{"version":' + json.dumps(get_mapping_version(db)).encode("utf-8") + b',"mappings":[')
+                rows = iter_mapping_rows(db); first = True
+                while True:
+                    part = [r for _, r in zip(range(MAPPING_ENCODE_CHUNK), rows)]
+                    if not part: break
+                    body = json.dumps(part, ensure_ascii=False, separators=(",", ":"))[1:-1].encode("utf-8")
+                    w(body if first else b"," + body); first = False
+                w(b"]}")
+                if z: z.close()
+                sha = out.h.hexdigest()
+            if ext: os.replace(tmp + ".z", MAPPING_JSON + ext)
+            else: os.remove(tmp + ".z")
+            os.replace(tmp, MAPPING_JSON)
+            _write_sidecar_sha(MAPPING_JSON, sha)
+            return sha
+        finally:
+            db.close()
+
+def write_mapping_json(db=None):
+    """登记一次 mapping.json 写盘（db 参数仅为兼容旧调用）；后台写线程未运行或未开启去抖时同步写出"""
+    if MAPPING_WRITE_DEBOUNCE <= 0 or not _mapping_writer["running"]:
+        write_mapping_file(); return
+    now = time.monotonic()
+    if _mapping_writer["first"] is None: _mapping_writer["first"] = now
+    _mapping_writer["due"] = min(now + MAPPING_WRITE_DEBOUNCE, _mapping_writer["first"] + MAPPING_WRITE_MAX_DELAY)
+    _mapping_write_wake.set()
+
+def _mapping_write_loop():
+    while True:
+        _mapping_write_wake.wait()
+        _mapping_write_wake.clear()
+        while (delay := _mapping_writer["due"] - time.monotonic()) > 0:
+            time.sleep(delay)
+        _mapping_writer["first"] = None
+        try: write_mapping_file()
+        except Exception as e: print("mapping write warn:", e)
+
+def flush_mapping_json():
+    """关停前写出尚未落盘的 mapping.json"""
+    if _mapping_writer["first"] is not None or _mapping_write_wake.is_set():
+        _mapping_writer["first"] = None; _mapping_write_wake.clear()
+        write_mapping_file()
 
 # ===== 每日ZIP =====
 def _date_str(d: date) -> str:
@@ -198,56 +911,134 @@ def _date_str_compact(d: date) -> str:
     try: return d.strftime("%Y%m%d")
     except Exception: return str(d).replace("-","")
 
-def build_daily_pdf_zip(db, target_date: Optional[date]=None) -> str:
-    """为 target_date（默认今天）重建仅包含当日上传/更新PDF的 zip；返回zip路径"""
+DAILY_ZIP_MIN_INTERVAL = int(os.environ.get("HUANDAN_DAILY_ZIP_INTERVAL", "30") or "30")
+_daily_zip_built = {}  # YYYYMMDD -> (mapping_version, monotonic 时间)
+
+class _HashingWriter:
+    """只追加的文件包装：边写边算 SHA-256。不支持 seek，zipfile 会自动改用数据描述符写成员头"""
+    def __init__(self, f):
+        self.f = f; self.h = hashlib.sha256(); self.pos = 0
+    def write(self, b):
+        self.f.write(b); self.h.update(b); self.pos += len(b)
+        return len(b)
+    def tell(self): return self.pos
+    def seek(self, *args): raise OSError("not seekable")
+    def flush(self): self.f.flush()
+
+def _zip_manifest_path(fp_zip: str) -> str:
+    return fp_zip + ".manifest.json"
+
+def _read_zip_manifest(fp_zip: str) -> dict:
+    try:
+        with open(_zip_manifest_path(fp_zip), "r", encoding="utf-8") as f:
+            m = json.load(f)
+        # 清单与实际 ZIP 不一致（例如中途崩溃）时视为无清单，走全量重建
+        if m.get("size") != os.path.getsize(fp_zip): return {}
+        return m
+    except Exception:
+        return {}
+
+def _write_zip_manifest(fp_zip: str, members: dict):
+    tmp = _zip_manifest_path(fp_zip) + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"size": os.path.getsize(fp_zip), "members": members}, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, _zip_manifest_path(fp_zip))
+
+def _write_daily_zip(tmp_zip: str, items: list, base_zip: Optional[str] = None) -> str:
+    """写出 ZIP_STORED 归档并返回 SHA-256。
+    base_zip 不为空时为追加：原样拷贝旧归档的成员数据（不含中央目录），再写入新成员与合并后的中央目录。"""
+    with open(tmp_zip, "wb") as raw:
+        w = _HashingWriter(raw)
+        old_infos = []
+        if base_zip:
+            with zipfile.ZipFile(base_zip, "r") as old:
+                old_infos = old.infolist()
+                remaining = old.start_dir  # 中央目录起点，之前即全部成员数据
+            with open(base_zip, "rb") as src:
+                while remaining > 0:
+                    buf = src.read(min(1024*1024, remaining))
+                    if not buf: raise IOError("daily zip truncated")
+                    w.write(buf); remaining -= len(buf)
+        with zipfile.ZipFile(w, "w", compression=zipfile.ZIP_STORED) as z:
+            for zi in old_infos:
+                z.filelist.append(zi); z.NameToInfo[zi.filename] = zi
+            for arcname, path in items:
+                if isinstance(path, tuple): z.writestr(arcname, read_packed(path))  # 冷归档成员
+                else: z.write(path, arcname)
+    return w.h.hexdigest()
+
+def build_daily_pdf_zip(db, target_date: Optional[date]=None, force: bool=False) -> str:
+    """增量维护 target_date（默认今天）的 zip：只有新增时追加，有替换/删除时才整包重写；返回zip路径。
+    mapping_version 未变化且距上次构建不足 DAILY_ZIP_MIN_INTERVAL 秒时直接返回（force 除外）。"""
     if target_date is None: target_date = datetime.utcnow().date()
+    key = _date_str_compact(target_date)
+    zip_name = f"pdfs-{key}.zip"
+    fp_zip   = os.path.join(ZIP_DIR, zip_name)
+    version = get_mapping_version(db)
+    last = _daily_zip_built.get(key)
+    if not force and last and (last[0] == version or time.monotonic() - last[1] < DAILY_ZIP_MIN_INTERVAL):
+        return fp_zip
+
+    day = _date_str(target_date)
+    rev = db.execute(text("SELECT rev FROM pdf_day WHERE day = :d"), {"d": day}).scalar()
     start_dt = datetime(target_date.year, target_date.month, target_date.day)
     end_dt   = start_dt + timedelta(days=1)
-    files = db.query(TrackingFile).filter(
+    rows = db.execute(select(TrackingFile.tracking_no, TrackingFile.file_path, TrackingFile.uploaded_at,
+                             TrackingFile.pack_path, TrackingFile.pack_offset, TrackingFile.pack_length).where(
         TrackingFile.uploaded_at >= start_dt,
         TrackingFile.uploaded_at <  end_dt
-    ).all()
-
-    zip_name = f"pdfs-{_date_str_compact(target_date)}.zip"
-    fp_zip   = os.path.join(ZIP_DIR, zip_name)
-    if not files:
+    )).all()
+    want = {}  # arcname -> (源文件或冷归档 (包, 偏移, 长度), 上传时间戳)
+    for tn, fpath, u, pk, off, n in rows:
+        if fpath and os.path.exists(fpath): src = fpath
+        elif pk and os.path.exists(pk): src = (pk, off, n)
+        else: continue
+        want[f"{canon_tracking(tn)}.pdf"] = (src, u.isoformat() if u else "")
+    _daily_zip_built[key] = (version, time.monotonic())
+    if not want:
         # 无文件：仍返回路径（可能不存在）
+        _mark_daily_zip(db, day, rev, fp_zip)
         return fp_zip
 
-    tmp_zip = fp_zip + ".tmp"
-    try:
-        with zipfile.ZipFile(tmp_zip, "w", compression=zipfile.ZIP_DEFLATED) as z:
-            for f in files:
-                try:
-                    if not f.file_path or (not os.path.exists(f.file_path)): continue
-                    arcname = f"{canon_tracking(f.tracking_no)}.pdf"
-                    z.write(f.file_path, arcname)
-                except Exception:
-                    pass
-        os.makedirs(os.path.dirname(fp_zip), exist_ok=True)
-        if os.path.exists(fp_zip):
-            try: os.replace(tmp_zip, fp_zip)
-            except Exception:
-                try: os.remove(fp_zip)
-                except Exception: pass
-                os.replace(tmp_zip, fp_zip)
+    # 多个 worker 可能同时重建同一天：按 ZIP 加文件锁，后拿到锁的一方读到新清单后直接返回
+    with file_lock(fp_zip + ".lock"):
+        stamps = {k: v[1] for k, v in want.items()}
+        manifest = _read_zip_manifest(fp_zip) if os.path.exists(fp_zip) else {}
+        have = manifest.get("members") or {}
+        if have == stamps and _read_sidecar_sha(fp_zip):
+            _mark_daily_zip(db, day, rev, fp_zip)
+            return fp_zip
+        appendable = bool(have) and all(stamps.get(k) == v for k, v in have.items())
+        if appendable:
+            items = [(k, want[k][0]) for k in sorted(want) if k not in have]
         else:
-            os.replace(tmp_zip, fp_zip)
-        # 写入 SHA256（供响应头使用）
-        try:
-            h=hashlib.sha256()
-            with open(fp_zip, "rb") as f:
-                for chunk in iter(lambda: f.read(1024*1024), b""):
-                    h.update(chunk)
-            _write_sidecar_sha(fp_zip, h.hexdigest())
-        except Exception:
-            pass
-    finally:
+            items = [(k, want[k][0]) for k in sorted(want)]
+
+        os.makedirs(os.path.dirname(fp_zip), exist_ok=True)
+        tmp_zip = fp_zip + ".tmp"
         try:
-            if os.path.exists(tmp_zip): os.remove(tmp_zip)
-        except Exception: pass
+            sha = _write_daily_zip(tmp_zip, items, fp_zip if appendable else None)
+            os.replace(tmp_zip, fp_zip)
+            _write_sidecar_sha(fp_zip, sha)
+            _write_zip_manifest(fp_zip, stamps)
+        finally:
+            try:
+                if os.path.exists(tmp_zip): os.remove(tmp_zip)
+            except Exception: pass
+    _mark_daily_zip(db, day, rev, fp_zip)
     return fp_zip
 
+def _mark_daily_zip(db, day: str, rev: Optional[int], fp_zip: str):
+    """记录当日 ZIP 对应的 rev/大小/sha；构建期间又有变化时 rev 已前进，ZIP 仍会被视为过期"""
+    if rev is None: return
+    try: size = os.path.getsize(fp_zip)
+    except OSError: size = None
+    db.execute(text("UPDATE pdf_day SET zip_rev = :r, zip_size = :n, zip_sha = :s WHERE day = :d"),
+               {"r": rev, "n": size, "s": _read_sidecar_sha(fp_zip) if size is not None else None, "d": day})
+    db.commit()
+    _daily_index["key"] = None
+    shm_add(SHM_ZIPS)
+
 def list_pdf_zip_dates() -> list:
     """扫描 ZIP_DIR 下所有 pdfs-YYYYMMDD.zip，返回按日期倒序的列表。"""
     out=[]
@@ -271,38 +1062,329 @@ def list_pdf_zip_dates() -> list:
         pass
     return out
 
+# 归档日期索引：pdf_day 汇总 + ZIP_DIR 列表，按 mapping_version 缓存，客户端轮询直接读内存；
+# 过期的 ZIP 只由后台线程重建（已有 ZIP 的日期、今天以及客户端请求过的日期）
+_daily_index = {"key": None, "dates": [], "by_date": {}}
+_zip_builder_wake = threading.Event()
+_zip_wanted = set()
+
+def daily_zip_index(db) -> list:
+    key = (get_mapping_version(db), shm_get(SHM_ZIPS))
+    idx = _daily_index
+    if idx["key"] == key: return idx["dates"]
+    zips = {x["date"]: x for x in list_pdf_zip_dates()}
+    out = []
+    for day, files, rev, zrev, zsha in db.execute(text("SELECT day, files, rev, zip_rev, zip_sha FROM pdf_day")):
+        z = zips.pop(day, None)
+        if (files or 0) <= 0 and not z: continue
+        fp = os.path.join(ZIP_DIR, z["zip_name"]) if z else None
+        out.append({"date": day, "zip_name": z["zip_name"] if z else f"pdfs-{day.replace('-','')}.zip",
+                    "size": z["size"] if z else 0, "files": files or 0,
+                    "sha256": (zsha or _read_sidecar_sha(fp) or "") if z else "",
+                    "stale": bool((files or 0) > 0 and (not z or zrev != rev))})
+    for d, z in zips.items():
+        out.append({**z, "files": 0, "sha256": _read_sidecar_sha(os.path.join(ZIP_DIR, z["zip_name"])) or "", "stale": False})
+    out.sort(key=lambda x: x.get("date",""), reverse=True)
+    _daily_index.update(key=key, dates=out, by_date={x["date"]: x for x in out})
+    return out
+
+def daily_zip_iter(db, days: list):
+    """重建指定日期的归档 ZIP（后台任务，产出进度）"""
+    yield {"phase": "repack", "total": len(days), "done": 0}
+    for n, d in enumerate(days, 1):
+        build_daily_pdf_zip(db, date.fromisoformat(d), force=True)
+        yield {"phase": "repack", "total": len(days), "done": n}
+    yield {"phase": "done", "days": days}
+
+def _zip_builder_loop():
+    """定期找出需要重建的日期并提交为 daily_zip 任务（已有排队中的同类任务时不重复提交）"""
+    while True:
+        _zip_builder_wake.wait(DAILY_ZIP_MIN_INTERVAL)
+        _zip_builder_wake.clear()
+        db = SessionLocal()
+        try:
+            today = _date_str(datetime.utcnow().date())
+            stale = [d for (d,) in db.execute(text(
+                "SELECT day FROM pdf_day WHERE files > 0 AND (zip_rev IS NULL OR zip_rev != rev) ORDER BY day DESC"))]
+            wanted = set(_zip_wanted); _zip_wanted.clear()
+            days = [d for d in stale if d == today or d in wanted or os.path.exists(os.path.join(ZIP_DIR, f"pdfs-{d.replace('-','')}.zip"))]
+            days += [d for d in sorted(wanted - set(stale), reverse=True)
+                     if not os.path.exists(os.path.join(ZIP_DIR, f"pdfs-{d.replace('-','')}.zip"))]
+            if days: enqueue_job("daily_zip", {"days": days}, dedupe=True)
+        except Exception as e:
+            print("daily zip warn:", e)
+        finally:
+            db.close()
+
+# -------- 冷归档 --------
+# 上传超过 PDF_COLD_DAYS 天的 PDF 不再单独占用文件：当日 ZIP（ZIP_STORED）硬链接为 PACK_DIR 下的只读包，
+# 登记每个成员数据的偏移与长度后删除原文件，下载时按偏移直接读取。包内容固定不变，之后当日 ZIP 重写也不受影响
+PDF_COLD_DAYS = int(os.environ.get("HUANDAN_PDF_COLD_DAYS", "7") or "7")
+PDF_TIER_LOCK_FILE = os.path.join(DATA_DIR, ".pdf-tier.lock")
+
+def _zip_member_spans(path: str) -> dict:
+    """ZIP_STORED 成员名 -> (数据偏移, 长度)；偏移按本地文件头计算（其 extra 长度可能与中央目录不同）"""
+    out = {}
+    with zipfile.ZipFile(path, "r") as z, open(path, "rb") as f:
+        for zi in z.infolist():
+            if zi.compress_type != zipfile.ZIP_STORED: continue
+            f.seek(zi.header_offset)
+            n, m = struct.unpack("<HH", f.read(30)[26:30])
+            out[zi.filename] = (zi.header_offset + 30 + n + m, zi.compress_size)
+    return out
+
+def _pack_pdf_day(db, day: str) -> int:
+    """把某天仍在 PDF_DIR 中的 PDF 转为冷归档，返回转换数"""
+    fp_zip = build_daily_pdf_zip(db, date.fromisoformat(day), force=True)
+    if not os.path.exists(fp_zip): return 0
+    with file_lock(fp_zip + ".lock"):
+        stamps = _read_zip_manifest(fp_zip).get("members") or {}
+        sha = _read_sidecar_sha(fp_zip) or str(time.time_ns())
+        pack = os.path.join(PACK_DIR, f"{os.path.basename(fp_zip)[:-4]}-{sha[:12]}.zip")
+        if not os.path.exists(pack):
+            try: os.link(fp_zip, pack)
+            except OSError: shutil.copyfile(fp_zip, pack)
+    spans = _zip_member_spans(pack)
+    start = datetime.fromisoformat(day)
+    rows = db.execute(text("SELECT tracking_no, file_path, sha256, uploaded_at FROM tracking_file "
+                           "WHERE pack_path IS NULL AND uploaded_at >= :a AND uploaded_at < :b"),
+                      {"a": _sqlite_ts(start), "b": _sqlite_ts(start + timedelta(days=1))}).all()
+    ups = []
+    for tn, fp, sha, u in rows:
+        arc = f"{canon_tracking(tn)}.pdf"
+        # 清单中的上传时间与当前登记一致才说明包里是同一份内容（ZIP 生成后又被重新导入的跳过）
+        if arc not in spans or stamps.get(arc) != datetime.fromisoformat(u).isoformat(): continue
+        ups.append((pack, spans[arc][0], spans[arc][1], tn, u))
+    if not ups: return 0
+    db.connection().exec_driver_sql(
+        "UPDATE tracking_file SET pack_path = ?, pack_offset = ?, pack_length = ? "
+        "WHERE tracking_no = ? AND uploaded_at = ? AND pack_path IS NULL", ups)
+    db.commit()
+    shm_add(SHM_PACKS)  # 先让各进程能找到包内位置，再删原文件
+    # 只删提交后确实指向本包的条目：UPDATE 期间被重新导入的行不匹配，盘上文件也可能已被新内容替换，
+    # 因此按库中当前登记重新查询，且仅在文件内容仍是归档那一份时才删除
+    for fp, sha in db.execute(text("SELECT file_path, sha256 FROM tracking_file WHERE pack_path = :p"), {"p": pack}).all():
+        if fp and sha and os.path.exists(fp) and _file_sha256(fp) == sha: unlink_pdf(fp, sha)
+    return len(ups)
+
+def _gc_pdf_packs(db) -> int:
+    used = set(db.execute(text("SELECT DISTINCT pack_path FROM tracking_file WHERE pack_path IS NOT NULL")).scalars())
+    removed = 0
+    for name in os.listdir(PACK_DIR):
+        p = os.path.join(PACK_DIR, name)
+        if name.endswith(".zip") and p not in used:
+            try: os.remove(p); removed += 1
+            except OSError: pass
+    return removed
+
+def pdf_tier_iter(db):
+    """冷归档（后台任务，产出进度）：逐日转换早于 PDF_COLD_DAYS 的 PDF，最后清理已无引用的包"""
+    with file_lock(PDF_TIER_LOCK_FILE, blocking=False) as got:
+        if not got or PDF_COLD_DAYS <= 0:
+            yield {"phase": "done", "days": 0, "packed": 0, "removed": 0}; return
+        cutoff = datetime.combine(datetime.utcnow().date() - timedelta(days=PDF_COLD_DAYS), datetime.min.time())
+        days = [d for (d,) in db.execute(text(
+            "SELECT DISTINCT substr(uploaded_at, 1, 10) FROM tracking_file WHERE pack_path IS NULL AND uploaded_at < :c ORDER BY 1"),
+            {"c": _sqlite_ts(cutoff)})]
+        packed = 0
+        yield {"phase": "tier", "total": len(days), "done": 0, "packed": 0}
+        for n, day in enumerate(days, 1):
+            packed += _pack_pdf_day(db, day)
+            yield {"phase": "tier", "total": len(days), "done": n, "packed": packed}
+        yield {"phase": "done", "days": len(days), "packed": packed, "removed": _gc_pdf_packs(db)}
+
 # -------- 认证、清理 --------
+# 访问码按 HMAC 摘要索引查找；校验成功的访问码在进程内缓存 AUTH_CACHE_TTL 秒，
+# last_used 先记在内存里，由后台线程批量写回，成功的请求不产生任何 DB 写入。
+AUTH_DIGEST_KEY = os.environ.get("SECRET_KEY","huandan-secret-key").encode("utf-8")
+AUTH_CACHE_TTL = int(os.environ.get("HUANDAN_AUTH_CACHE_TTL", "60") or "60")
+AUTH_FLUSH_SECONDS = int(os.environ.get("HUANDAN_AUTH_FLUSH_SECONDS", "30") or "30")
+AUTH_MAX_FAILS = 5
+AUTH_LOCK_MINUTES = 5
+
+_auth_lock = threading.Lock()
+_auth_cache = {}          # code -> (client_id, expires_at)
+_auth_last_used = {}      # client_id -> datetime（待写回）
+# 连续失败计数与全局锁定时间（epoch 秒）放在共享槽位 SHM_AUTH_FAILS/SHM_AUTH_LOCKED，各 worker 共同累计；
+# SHM_AUTH 为缓存代数，任一进程启停/删除访问码后递增，其他进程随之清空缓存
+_auth_gen = {"value": -1}
+
+def code_digest(code: str) -> str:
+    return hmac.new(AUTH_DIGEST_KEY, (code or "").encode("utf-8"), hashlib.sha256).hexdigest()
+
 def is_locked(c: ClientAuth) -> bool:
     return bool(c.locked_until and datetime.utcnow() < c.locked_until)
 
+def _auth_cache_drop(client_id: Optional[int] = None):
+    """访问码启停/删除后调用；client_id 为空时清空全部缓存"""
+    shm_add(SHM_AUTH)
+    with _auth_lock:
+        if client_id is None:
+            _auth_cache.clear(); return
+        for k in [k for k, v in _auth_cache.items() if v[0] == client_id]:
+            _auth_cache.pop(k, None)
+
+def _auth_mark_ok(code: str, client_id: int):
+    now = time.monotonic()
+    with _auth_lock:
+        _auth_cache[code] = (client_id, now + AUTH_CACHE_TTL)
+        _auth_last_used[client_id] = datetime.utcnow()
+    if shm_get(SHM_AUTH_FAILS):
+        with shm_locked():
+            shm_set(SHM_AUTH_FAILS, 0); shm_set(SHM_AUTH_LOCKED, 0)
+
+def _auth_mark_fail():
+    with shm_locked():
+        if shm_add(SHM_AUTH_FAILS) >= AUTH_MAX_FAILS:
+            shm_set(SHM_AUTH_LOCKED, int(time.time()) + AUTH_LOCK_MINUTES * 60)
+
+def flush_last_used():
+    """把内存中累积的 last_used 批量写回 client_auth"""
+    with _auth_lock:
+        pending = dict(_auth_last_used); _auth_last_used.clear()
+    if not pending: return 0
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("UPDATE client_auth SET last_used=:ts WHERE id=:id"),
+                         [{"id": k, "ts": v} for k, v in pending.items()])
+    except Exception as e:
+        print("flush last_used warn:", e)
+    return len(pending)
+
+def _auth_flush_loop():
+    while True:
+        time.sleep(AUTH_FLUSH_SECONDS)
+        flush_last_used()
+
 def verify_code(db, code: str):
+    """校验 6 位访问码；成功返回 client_id，失败返回 None"""
     if not code or not code.isdigit() or len(code)!=6: return None
-    rows = db.execute(select(ClientAuth).where(ClientAuth.is_active==True)).scalars().all()
+    now = time.monotonic()
+    gen = shm_get(SHM_AUTH)
+    with _auth_lock:
+        if gen != _auth_gen["value"]:
+            _auth_cache.clear(); _auth_gen["value"] = gen
+        hit = _auth_cache.get(code)
+        if hit and hit[1] > now:
+            _auth_last_used[hit[0]] = datetime.utcnow()
+            return hit[0]
+    if time.time() < shm_get(SHM_AUTH_LOCKED): return None
+
+    dg = code_digest(code)
+    rows = db.execute(select(ClientAuth).where(ClientAuth.code_digest==dg, ClientAuth.is_active==True)).scalars().all()
     for c in rows:
         if is_locked(c): continue
         if (c.code_plain == code) or (c.code_hash and bcrypt.verify(code, c.code_hash)):
-            c.last_used = datetime.utcnow(); c.fail_count = 0; c.locked_until=None; db.commit(); return c
-    for c in rows:
-        c.fail_count = (c.fail_count or 0) + 1
-        if c.fail_count >= 5: c.locked_until = datetime.utcnow() + timedelta(minutes=5)
-    db.commit(); return None
+            _auth_mark_ok(code, c.id); return c.id
+    # 兜底：仅有 bcrypt 哈希、尚未写入摘要的旧记录；命中后补写摘要，之后走索引
+    legacy = db.execute(select(ClientAuth).where(
+        ClientAuth.code_digest.is_(None), ClientAuth.code_hash.isnot(None), ClientAuth.is_active==True
+    )).scalars().all()
+    for c in legacy:
+        if is_locked(c): continue
+        if c.code_hash and bcrypt.verify(code, c.code_hash):
+            c.code_digest = dg; db.commit()
+            _auth_mark_ok(code, c.id); return c.id
+    _auth_mark_fail(); return None
 
-def cleanup_expired(db):
+def _ensure_code_digests():
+    """启动时为明码访问码补齐/刷新摘要；SECRET_KEY 变化后旧摘要全部作废"""
+    db = SessionLocal()
+    try:
+        key_fp = hashlib.sha256(AUTH_DIGEST_KEY).hexdigest()[:16]
+        key_changed = get_kv(db, "code_digest_key", "") != key_fp
+        for c in db.query(ClientAuth).all():
+            if c.code_plain:
+                dg = code_digest(c.code_plain)
+                if c.code_digest != dg: c.code_digest = dg
+            elif key_changed:
+                c.code_digest = None
+        db.commit()
+        if key_changed: set_kv(db, "code_digest_key", key_fp)
+    finally:
+        db.close()
+
+RETENTION_BATCH = 5000
+_retention_lock = threading.Lock()
+RETENTION_LOCK_FILE = os.path.join(DATA_DIR, ".retention.lock")
+_retention_wake = threading.Event()
+
+def _retention_interval_minutes(db) -> int:
+    try: return max(1, int(get_kv(db, "retention_interval_minutes", "60") or "60"))
+    except Exception: return 60
+
+def cleanup_expired(db) -> dict:
+    """按保留期分批删除过期订单与 PDF（集合式 SQL，每批单独提交），结束后只升级一次映射版本。
+    由后台保留期任务调用，不在页面请求中执行。"""
     o_days = int(get_kv(db, 'retention_orders_days', '0') or '0')
     f_days = int(get_kv(db, 'retention_files_days', '0') or '0')
+    stats = {"orders": 0, "files": 0}
+    conn = db.connection()
     if o_days > 0:
-        dt = datetime.utcnow() - timedelta(days=o_days)
-        db.query(OrderMapping).filter(OrderMapping.updated_at < dt).delete()
+        dt = _sqlite_ts(datetime.utcnow() - timedelta(days=o_days))
+        pick = "SELECT rowid FROM order_mapping WHERE updated_at < ? ORDER BY rowid LIMIT ?"
+        while True:
+            conn.exec_driver_sql(
+                f"INSERT INTO mapping_change (kind, key, tracking_no) SELECT 'order', order_id, tracking_no FROM order_mapping WHERE rowid IN ({pick})",
+                (dt, RETENTION_BATCH))
+            n = conn.exec_driver_sql(f"DELETE FROM order_mapping WHERE rowid IN ({pick})", (dt, RETENTION_BATCH)).rowcount
+            db.commit(); conn = db.connection()
+            stats["orders"] += n
+            if n < RETENTION_BATCH: break
     if f_days > 0:
-        dt = datetime.utcnow() - timedelta(days=f_days)
-        olds = db.query(TrackingFile).filter(TrackingFile.uploaded_at < dt).all()
-        for r in olds:
-            try:
-                if r.file_path and os.path.exists(r.file_path): os.remove(r.file_path)
-            except Exception:
-                pass
-            db.delete(r)
+        dt = _sqlite_ts(datetime.utcnow() - timedelta(days=f_days))
+        while True:
+            olds = conn.exec_driver_sql(
+                "SELECT rowid, tracking_no, file_path, sha256 FROM tracking_file WHERE uploaded_at < ? ORDER BY rowid LIMIT ?",
+                (dt, RETENTION_BATCH)).fetchall()
+            if not olds: break
+            conn.exec_driver_sql("INSERT INTO mapping_change (kind, key, tracking_no) VALUES ('file', ?, ?)", [(r[1], r[1]) for r in olds])
+            conn.exec_driver_sql("DELETE FROM tracking_file WHERE rowid = ?", [(r[0],) for r in olds])
+            db.commit(); conn = db.connection()
+            pdf_index_drop([r[1] for r in olds])
+            for r in olds: unlink_pdf(r[2], r[3])
+            stats["files"] += len(olds)
+            if len(olds) < RETENTION_BATCH: break
     db.commit()
+    if stats["orders"] or stats["files"]: set_mapping_version(db); write_mapping_json(db)
+    return stats
+
+def run_retention():
+    """执行一次保留期清理并记录结果（供仪表盘展示）；同一时刻（跨 worker）只运行一个"""
+    if not _retention_lock.acquire(blocking=False): return None
+    with file_lock(RETENTION_LOCK_FILE, blocking=False) as got:
+        if not got:
+            _retention_lock.release(); return None
+        return _run_retention_locked()
+
+def _run_retention_locked():
+    db = WriteSession()
+    try:
+        t0 = time.monotonic()
+        stats = cleanup_expired(db)
+        set_kv(db, "retention_last_run", now_iso())
+        set_kv(db, "retention_last_result", json.dumps({**stats, "seconds": round(time.monotonic() - t0, 2)}))
+        return stats
+    except Exception as e:
+        db.rollback()
+        print("retention warn:", e)
+        try: set_kv(db, "retention_last_result", json.dumps({"error": str(e)}, ensure_ascii=False))
+        except Exception: pass
+    finally:
+        db.close(); _retention_lock.release()
+
+def _retention_loop():
+    _retention_wake.wait(30)  # 启动后稍等再跑，避免拖慢启动
+    while True:
+        _retention_wake.clear()
+        run_retention()
+        if PDF_COLD_DAYS > 0:
+            try: enqueue_job("pdf_tier", dedupe=True)
+            except Exception as e: print("pdf tier warn:", e)
+        db = SessionLocal()
+        try: minutes = _retention_interval_minutes(db)
+        finally: db.close()
+        _retention_wake.wait(minutes * 60)
 
 # -------- 启动钩子：建表 + 默认管理员 --------
 def _ensure_default_admin():
@@ -326,13 +1408,137 @@ def _ensure_default_admin():
     except Exception as e:
         print("ensure admin warn:", e)
 
+def _ensure_columns():
+    """为旧库补齐后续版本新增的列与索引（create_all 不会修改已有表）"""
+    wanted = {
+        "client_auth": [("code_digest", "VARCHAR(64)")],
+        "tracking_file": [("sha256", "VARCHAR(64)"), ("pack_path", "TEXT"), ("pack_offset", "INTEGER"), ("pack_length", "INTEGER")],
+    }
+    indexes = [
+        "CREATE INDEX IF NOT EXISTS ix_client_auth_code_digest ON client_auth (code_digest)",
+        "CREATE INDEX IF NOT EXISTS ix_tracking_file_sha256 ON tracking_file (sha256)",
+        "CREATE INDEX IF NOT EXISTS ix_tracking_file_uploaded_at ON tracking_file (uploaded_at)",
+        "CREATE INDEX IF NOT EXISTS ix_order_mapping_updated_at ON order_mapping (updated_at)",
+    ]
+    with engine.begin() as conn:
+        for table, cols in wanted.items():
+            have = {r[1] for r in conn.execute(text(f"PRAGMA table_info({table})"))}
+            for name, ddl in cols:
+                if name not in have:
+                    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+        for ddl in indexes:
+            conn.execute(text(ddl))
+
+# 列表搜索：FTS5 trigram 外部内容表，触发器随主表同步；SQLite 不支持时回退 LIKE 全表扫描
+SEARCH_TABLES = {
+    "order_mapping": "order_id",
+    "tracking_file": "tracking_no",
+}
+_search_fts = {"enabled": False}
+
+def _ensure_search_index():
+    with engine.begin() as conn:
+        for table, col in SEARCH_TABLES.items():
+            fts = f"{table}_fts"
+            fresh = not conn.execute(text("SELECT 1 FROM sqlite_master WHERE type='table' AND name=:n"), {"n": fts}).first()
+            conn.execute(text(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({col}, content='{table}', content_rowid='rowid', tokenize='trigram')"))
+            conn.execute(text(f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+                              f"INSERT INTO {fts}(rowid, {col}) VALUES (new.rowid, new.{col}); END"))
+            conn.execute(text(f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+                              f"INSERT INTO {fts}({fts}, rowid, {col}) VALUES ('delete', old.rowid, old.{col}); END"))
+            # upsert 只改其它列，不会触发；仅主键本身变化时才需要重建该行
+            conn.execute(text(f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {col} ON {table} BEGIN "
+                              f"INSERT INTO {fts}({fts}, rowid, {col}) VALUES ('delete', old.rowid, old.{col}); "
+                              f"INSERT INTO {fts}(rowid, {col}) VALUES (new.rowid, new.{col}); END"))
+            if fresh:
+                conn.execute(text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+    _search_fts["enabled"] = True
+
+def db_vacuum_iter(db):
+    """整理数据库（后台任务）：VACUUM 回收空间。搜索索引按主表 rowid 关联，
+    VACUUM 可能重排没有 INTEGER PRIMARY KEY 的表的 rowid，因此随后重建索引"""
+    yield {"phase": "vacuum", "msg": "整理数据库…"}
+    db.commit()
+    db.connection().exec_driver_sql("VACUUM")
+    conn = db.connection()
+    for table in SEARCH_TABLES:
+        if conn.execute(text("SELECT 1 FROM sqlite_master WHERE type='table' AND name=:n"), {"n": f"{table}_fts"}).first():
+            yield {"phase": "vacuum", "msg": f"重建搜索索引 {table}…"}
+            conn.exec_driver_sql(f"INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')")
+    db.commit()
+    shm_add(SHM_VACUUM)
+    yield {"phase": "done", "redirect": "/admin/jobs"}
+
+def _ensure_pdf_day_triggers():
+    """pdf_day 由触发器随 tracking_file 的增删改同步；首次创建触发器时按现有数据回填"""
+    bump = ("INSERT INTO pdf_day (day, files, rev) SELECT substr({r}.uploaded_at, 1, 10), {n}, 1 WHERE {r}.uploaded_at IS NOT NULL "
+            "ON CONFLICT(day) DO UPDATE SET files = files + ({n}), rev = rev + 1")
+    add, sub = bump.format(r="new", n=1), bump.format(r="old", n=-1)
+    # 重新导入会改 uploaded_at/sha256：旧日期减一、新日期加一，两天的 ZIP 都标记为过期；
+    # 只改 file_path 的是目录迁移，内容不变，不触发
+    au = f"CREATE TRIGGER pdf_day_au AFTER UPDATE OF uploaded_at, sha256 ON tracking_file BEGIN {sub}; {add}; END"
+    with engine.begin() as conn:
+        if conn.execute(text("SELECT 1 FROM sqlite_master WHERE type='trigger' AND name='pdf_day_ai'")).first():
+            old = conn.execute(text("SELECT sql FROM sqlite_master WHERE type='trigger' AND name='pdf_day_au'")).scalar()
+            if old and "file_path" in old:
+                conn.execute(text("DROP TRIGGER pdf_day_au")); conn.execute(text(au))
+            return
+        conn.execute(text("DELETE FROM pdf_day"))
+        # 已有的归档视为与当前数据一致（zip_rev = rev），升级后不整体重建
+        conn.execute(text("INSERT INTO pdf_day (day, files, rev, zip_rev) SELECT substr(uploaded_at, 1, 10), count(*), 1, 1 "
+                          "FROM tracking_file WHERE uploaded_at IS NOT NULL GROUP BY 1"))
+        conn.execute(text(f"CREATE TRIGGER pdf_day_ai AFTER INSERT ON tracking_file BEGIN {add}; END"))
+        conn.execute(text(f"CREATE TRIGGER pdf_day_ad AFTER DELETE ON tracking_file BEGIN {sub}; END"))
+        conn.execute(text(au))
+
+STARTUP_LOCK_FILE = os.path.join(DATA_DIR, ".startup.lock")
+
 @app.on_event("startup")
 def _init_db():
-    try:
-        Base.metadata.create_all(bind=engine, checkfirst=True)
-    except Exception as e:
-        print("DB init warn:", e)
-    _ensure_default_admin()
+    # 多个 worker 同时启动：建表/迁移/补默认管理员/恢复任务依次执行，后启动的进程看到的是已完成的结果
+    with file_lock(STARTUP_LOCK_FILE):
+        try:
+            Base.metadata.create_all(bind=engine, checkfirst=True)
+            _ensure_columns()
+            _ensure_code_digests()
+            _ensure_changelog_floor()
+        except Exception as e:
+            print("DB init warn:", e)
+        try:
+            _ensure_pdf_day_triggers()
+        except Exception as e:
+            print("pdf_day warn:", e)
+        try:
+            _ensure_search_index()
+        except Exception as e:
+            print("search index warn (fallback to LIKE):", e)
+        try:
+            db = SessionLocal()
+            try: pdf_index_reload(db)
+            finally: db.close()
+        except Exception as e:
+            print("pdf index warn:", e)
+        _ensure_default_admin()
+        try: _queue_stale_trash()
+        except Exception as e: print("trash scan warn:", e)
+        threading.Thread(target=_unlink_loop, name="unlink", daemon=True).start()
+        try:
+            JobBase.metadata.create_all(bind=job_engine, checkfirst=True)
+            _recover_jobs()
+        except Exception as e:
+            print("job db warn:", e)
+    threading.Thread(target=_job_dispatch_loop, name="job-dispatch", daemon=True).start()
+    threading.Thread(target=_zip_builder_loop, name="daily-zip", daemon=True).start()
+    _mapping_writer["running"] = True
+    threading.Thread(target=_mapping_write_loop, name="mapping-writer", daemon=True).start()
+    threading.Thread(target=_auth_flush_loop, name="auth-flush", daemon=True).start()
+    threading.Thread(target=_retention_loop, name="retention", daemon=True).start()
+
+@app.on_event("shutdown")
+def _flush_on_shutdown():
+    flush_last_used()
+    try: flush_mapping_json()
+    except Exception as e: print("mapping flush warn:", e)
 
 # ------------------ 管理端认证与页面 ------------------
 @app.get("/admin/login", response_class=HTMLResponse)
@@ -373,7 +1579,9 @@ def bootstrap_do(request: Request, username: str = Form(...), password: str = Fo
 # 仪表盘
 @app.get("/admin", response_class=HTMLResponse)
 def dashboard(request: Request, db=Depends(get_db)):
-    require_admin(request, db); cleanup_expired(db)
+    require_admin(request, db)
+    try: retention = json.loads(get_kv(db, "retention_last_result", "") or "{}")
+    except Exception: retention = {}
     stats = {
         "order_count": db.query(OrderMapping).count(),
         "file_count": db.query(TrackingFile).count(),
@@ -383,6 +1591,9 @@ def dashboard(request: Request, db=Depends(get_db)):
         "client_recommend": get_kv(db,"client_recommend","client-20250916b"),
         "o_days": get_kv(db,"retention_orders_days","30"),
         "f_days": get_kv(db,"retention_files_days","30"),
+        "retention_interval": _retention_interval_minutes(db),
+        "retention_last_run": get_kv(db, "retention_last_run", ""),
+        "retention_last": retention,
     }
     return templates.TemplateResponse("dashboard.html", {"request": request, "stats": stats})
 
@@ -503,6 +1714,114 @@ def templates_save(request: Request, path: str = Form(...), content: str = Form(
     return RedirectResponse(f"/admin/templates/edit?path={path}&saved=1", status_code=302)
 
 # ------------------ 订单导入（3步） + 进度SSE ------------------
+ORDER_IMPORT_CHUNK = 5000
+ORDER_PREVIEW_ROWS = 50
+UPLOAD_CHUNK = 1024 * 1024
+
+async def save_upload(upload: UploadFile, dst: str) -> int:
+    """上传分块写盘，不把整个文件读进内存；返回字节数"""
+    size = 0
+    async with aiofiles.open(dst, "wb") as f:
+        while True:
+            chunk = await upload.read(UPLOAD_CHUNK)
+            if not chunk: break
+            await f.write(chunk); size += len(chunk)
+    return size
+
+def _is_csv(path: str) -> bool:
+    return path.lower().endswith(".csv")
+
+def read_order_columns(path: str) -> list:
+    """只读表头（列名与 pandas 全量读取时一致，含重名/空列的改名规则）"""
+    if _is_csv(path): return list(pd.read_csv(path, nrows=0).columns)
+    return list(pd.read_excel(path, nrows=0).columns)
+
+def read_order_preview(path: str, order_col: str, tracking_col: str, n: int = ORDER_PREVIEW_ROWS) -> list:
+    if _is_csv(path): df = pd.read_csv(path, dtype=str, nrows=n)
+    else: df = pd.read_excel(path, dtype=str, nrows=n)
+    return df[[order_col, tracking_col]].fillna("").values.tolist()
+
+def estimate_order_rows(path: str) -> int:
+    """估算数据行数（仅用于进度显示）：CSV 按换行计数，XLSX 取工作表维度"""
+    try:
+        if _is_csv(path):
+            n = 0; last = b"\n"
+            with open(path, "rb") as f:
+                for buf in iter(lambda: f.read(UPLOAD_CHUNK), b""):
+                    n += buf.count(b"\n"); last = buf[-1:]
+            if last != b"\n": n += 1
+            return max(0, n - 1)
+        if path.lower().endswith(".xlsx"):
+            from openpyxl import load_workbook
+            wb = load_workbook(path, read_only=True, data_only=True)
+            try: return max(0, (wb.worksheets[0].max_row or 1) - 1)
+            finally: wb.close()
+    except Exception:
+        pass
+    return 0
+
+def _xlsx_cell(v):
+    if v is None: return ""
+    if isinstance(v, float) and v.is_integer(): v = int(v)
+    return str(v)
+
+def iter_order_chunks(path: str, order_col: str, tracking_col: str, chunksize: int = ORDER_IMPORT_CHUNK):
+    """按块读取订单/运单两列，内存占用与文件大小无关。
+    CSV 用 read_csv(chunksize)；XLSX 用 openpyxl 只读模式逐行读取；旧版 XLS 只能整表读取。"""
+    if _is_csv(path):
+        yield from pd.read_csv(path, dtype=str, usecols=[order_col, tracking_col], chunksize=chunksize)
+        return
+    if path.lower().endswith(".xlsx"):
+        cols = read_order_columns(path)
+        oi, ti = cols.index(order_col), cols.index(tracking_col)
+        from openpyxl import load_workbook
+        wb = load_workbook(path, read_only=True, data_only=True)
+        try:
+            rows = wb.worksheets[0].iter_rows(min_row=2, values_only=True)
+            buf = []
+            for r in rows:
+                buf.append((_xlsx_cell(r[oi]) if oi < len(r) else "", _xlsx_cell(r[ti]) if ti < len(r) else ""))
+                if len(buf) >= chunksize:
+                    yield pd.DataFrame(buf, columns=[order_col, tracking_col]); buf = []
+            if buf: yield pd.DataFrame(buf, columns=[order_col, tracking_col])
+        finally:
+            wb.close()
+        return
+    df = pd.read_excel(path, dtype=str, usecols=[order_col, tracking_col])
+    for start in range(0, len(df), chunksize):
+        yield df.iloc[start:start+chunksize]
+
+def _sqlite_ts(dt: datetime) -> str:
+    # 与 SQLAlchemy DateTime 在 SQLite 中的存储格式一致
+    return dt.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+def normalize_order_frame(df: "pd.DataFrame", order_col: str, tracking_col: str) -> "pd.DataFrame":
+    """取出订单/运单两列并规范化，丢弃任一列为空的行"""
+    out = pd.DataFrame({
+        "order_id": df[order_col].fillna("").astype(str).str.strip(),
+        "tracking_no": canon_tracking_series(df[tracking_col]),
+    })
+    return out[(out["order_id"] != "") & (out["tracking_no"] != "")]
+
+def upsert_orders(db, frame: "pd.DataFrame", now: datetime) -> int:
+    """批量写入（INSERT ... ON CONFLICT DO UPDATE + executemany），并记录变更日志；不提交事务"""
+    if frame.empty: return 0
+    frame = frame.drop_duplicates("order_id", keep="last")  # 同一订单号以最后一行为准
+    ts = _sqlite_ts(now)
+    pairs = list(zip(frame["order_id"].tolist(), frame["tracking_no"].tolist()))
+    conn = db.connection()
+    # 运单号发生变化的订单，先记下旧运单号（增量同步需要）
+    conn.exec_driver_sql(
+        "INSERT INTO mapping_change (kind, key, tracking_no) "
+        "SELECT 'order', order_id, tracking_no FROM order_mapping WHERE order_id = ? AND tracking_no <> ?",
+        pairs)
+    conn.exec_driver_sql("INSERT INTO mapping_change (kind, key, tracking_no) VALUES ('order', ?, ?)", pairs)
+    conn.exec_driver_sql(
+        "INSERT INTO order_mapping (order_id, tracking_no, updated_at) VALUES (?, ?, ?) "
+        "ON CONFLICT(order_id) DO UPDATE SET tracking_no=excluded.tracking_no, updated_at=excluded.updated_at",
+        [(oid, tn, ts) for oid, tn in pairs])
+    return len(pairs)
+
 @app.get("/admin/upload-orders", response_class=HTMLResponse)
 def upload_orders_page(request: Request, db=Depends(get_db)):
     require_admin(request, db)
@@ -511,75 +1830,66 @@ def upload_orders_page(request: Request, db=Depends(get_db)):
 @app.post("/admin/upload-orders-step1", response_class=HTMLResponse)
 async def upload_orders_step1(request: Request, file: UploadFile = File(...), db=Depends(get_db)):
     require_admin(request, db)
-    tmp = os.path.join(UP_DIR, f"orders-{int(time.time())}-{re.sub(r'[^A-Za-z0-9_.-]+','_',file.filename)}")
-    with open(tmp, "wb") as f: f.write(await file.read())
+    tmp = os.path.join(UP_DIR, f"orders-{time.time_ns()}-{re.sub(r'[^A-Za-z0-9_.-]+','_',file.filename)}")
+    await save_upload(file, tmp)
     try:
-        if tmp.lower().endswith(".csv"): df = pd.read_csv(tmp, nrows=1)
-        else: df = pd.read_excel(tmp, nrows=1)
+        columns = await run_heavy(read_order_columns, tmp)
     except Exception as e:
         return templates.TemplateResponse("upload_orders.html", {"request": request, "err": f"读取失败：{e}"})
     request.session["last_orders_tmp"] = tmp
-    return templates.TemplateResponse("choose_columns.html", {"request": request, "columns": list(df.columns)})
+    return templates.TemplateResponse("choose_columns.html", {"request": request, "columns": columns})
 
 @app.post("/admin/upload-orders-step2", response_class=HTMLResponse)
-def upload_orders_step2(request: Request, order_col: str = Form(...), tracking_col: str = Form(...), db=Depends(get_db)):
+async def upload_orders_step2(request: Request, order_col: str = Form(...), tracking_col: str = Form(...), db=Depends(get_db)):
     require_admin(request, db)
     tmp = request.session.get("last_orders_tmp")
     if not tmp or not os.path.exists(tmp): return RedirectResponse("/admin/upload-orders", status_code=302)
-    if tmp.lower().endswith(".csv"): df = pd.read_csv(tmp, dtype=str)
-    else: df = pd.read_excel(tmp, dtype=str)
-    df = df.fillna("")
-    prev = df[[order_col, tracking_col]].head(50).values.tolist()
+    prev = await run_heavy(read_order_preview, tmp, order_col, tracking_col)
     request.session["orders_cols"] = {"order": order_col, "tracking": tracking_col}
     return templates.TemplateResponse("preview_orders.html", {"request": request, "rows": prev})
 
-# 新增：订单导入 SSE（前端按钮调用）
-@app.get("/admin/api/orders-apply")
-def orders_apply_sse(request: Request, db=Depends(get_db)):
+def import_orders_iter(db, tmp: str, cols: dict):
+    """订单导入（生成器，产出 SSE 进度）：逐块读取、逐块写入并提交。
+    每块单独提交，写锁只占一块的时间，其他写入（包括其他 worker）可以穿插进行。
+    导入进行中已提交的块不发布（变更日志版本为空），结束时统一升级版本；
+    中途失败时已提交的块不回滚，同样立即发布，客户端得到的是部分导入，重新导入同一文件即可补齐"""
+    total = estimate_order_rows(tmp); count = 0
+    yield {"phase":"read","total": total}
+    now = datetime.utcnow(); done = 0; committed = False
+    try:
+        for part in iter_order_chunks(tmp, cols["order"], cols["tracking"]):
+            frame = normalize_order_frame(part, cols["order"], cols["tracking"])
+            count += len(frame)
+            upsert_orders(db, frame, now); db.commit(); committed = True
+            done += len(part); total = max(total, done)
+            yield {"phase":"progress","done": done, "total": total}
+    finally:
+        # 失败时也发布已提交的部分：版本、mapping.json 与 ETag 立即与库一致，不留给下一次无关写入顺带发布
+        if committed:
+            db.rollback()
+            set_mapping_version(db); write_mapping_json(db)
+    try:
+        os.remove(tmp)
+    except Exception:
+        pass
+    yield {"phase":"done","count": count,"redirect":"/admin/orders"}
+
+# 订单导入：提交后台任务，页面再接 /admin/api/jobs/{id}/events；
+# 同一份上传重复提交（重试、断线后再点）返回同一个任务，不会导入两次
+@app.post("/admin/api/orders-apply")
+def orders_apply(request: Request, db=Depends(get_db)):
     require_admin(request, db)
     tmp = request.session.get("last_orders_tmp")
     cols = request.session.get("orders_cols") or {}
-    if not tmp or not os.path.exists(tmp) or "order" not in cols or "tracking" not in cols:
-        def _err():
-            yield _sse({"phase":"error","msg":"未找到待导入数据，请重新上传并选择列"})
-        return StreamingResponse(_err(), media_type="text/event-stream", headers={"Cache-Control":"no-cache"})
-
-    def _stream():
-        total = 0; count = 0
-        try:
-            if tmp.lower().endswith(".csv"): df = pd.read_csv(tmp, dtype=str)
-            else: df = pd.read_excel(tmp, dtype=str)
-            df = df.fillna("")
-            total = len(df)
-            yield _sse({"phase":"read","total": total})
-            now = datetime.utcnow()
-            for i, r in df.iterrows():
-                oid = str(r[cols["order"]]).strip()
-                tn  = canon_tracking(str(r[cols["tracking"]]).strip())
-                if oid and tn:
-                    m = db.get(OrderMapping, oid)
-                    if not m:
-                        m = OrderMapping(order_id=oid, tracking_no=tn, updated_at=now); db.add(m)
-                    else:
-                        m.tracking_no = tn; m.updated_at = now
-                    count += 1
-                if (i+1) % 200 == 0:
-                    db.commit()
-                    yield _sse({"phase":"progress","done": i+1, "total": total})
-            db.commit()
-            set_mapping_version(db); write_mapping_json(db)
-            # 清理 session 与临时文件
-            try:
-                os.remove(tmp)
-            except Exception:
-                pass
-            request.session.pop("last_orders_tmp", None)
-            request.session.pop("orders_cols", None)
-            yield _sse({"phase":"done","count": count,"redirect":"/admin/orders"})
-        except Exception as e:
-            db.rollback()
-            yield _sse({"phase":"error","msg": f"导入失败：{e}"})
-    return StreamingResponse(_stream(), media_type="text/event-stream", headers={"Cache-Control":"no-cache"})
+    if not tmp or "order" not in cols or "tracking" not in cols:
+        raise HTTPException(status_code=404, detail="未找到待导入数据，请重新上传并选择列")
+    args = {"tmp": tmp, "cols": {"order": cols["order"], "tracking": cols["tracking"]}}
+    if not os.path.exists(tmp):  # 已导入完成的临时文件会被删除，仍可取回原任务
+        jid = find_job("orders_import", args)
+        if not jid: raise HTTPException(status_code=404, detail="未找到待导入数据，请重新上传并选择列")
+    else:
+        jid = enqueue_job("orders_import", args, once=True)
+    return job_submitted(request, jid)
 
 # ------------------ PDF 导入（ZIP） + 进度SSE ------------------
 @app.get("/admin/upload-pdf", response_class=HTMLResponse)
@@ -591,149 +1901,263 @@ def upload_pdf_page(request: Request, db=Depends(get_db)):
 @app.post("/admin/api/upload-pdf-file")
 async def api_upload_pdf_file(request: Request, zipfile_upload: UploadFile = File(...), db=Depends(get_db)):
     require_admin(request, db)
-    tmp_name = f"pdfs-{int(time.time())}-{re.sub(r'[^A-Za-z0-9_.-]+','_',zipfile_upload.filename)}"
+    tmp_name = f"pdfs-{time.time_ns()}-{re.sub(r'[^A-Za-z0-9_.-]+','_',zipfile_upload.filename)}"
     tmp_zip = os.path.join(UP_DIR, tmp_name)
-    with open(tmp_zip, "wb") as f:
-        f.write(await zipfile_upload.read())
+    await save_upload(zipfile_upload, tmp_zip)
     return {"ok": True, "tmp": tmp_name}
 
-# 第二步：SSE 解压→入库→重建当日ZIP
-@app.get("/admin/api/apply-pdf-import")
-def api_apply_pdf_import(request: Request, tmp: str = Query(...), db=Depends(get_db)):
-    require_admin(request, db)
-    tmp_zip = _safe_join_uploads(tmp)
-    if not (tmp_zip and os.path.exists(tmp_zip)):
-        def _err():
-            yield _sse({"phase":"error","msg":"临时ZIP不存在，请重新上传"})
-        return StreamingResponse(_err(), media_type="text/event-stream", headers={"Cache-Control":"no-cache"})
-
-    def _stream():
-        saved=0; skipped=0
-        try:
-            with zipfile.ZipFile(tmp_zip, "r") as z:
-                members = [m for m in z.namelist() if (m and not m.endswith("/") and m.lower().endswith(".pdf"))]
-                total = len(members)
-                done = 0
-                yield _sse({"phase":"unzip","total": total, "done": done})
-                for m in members:
-                    try:
-                        tracking = canon_tracking(os.path.splitext(os.path.basename(m))[0])
-                        if not tracking:
-                            skipped += 1
-                            continue
-                        target = os.path.join(PDF_DIR, f"{tracking}.pdf")
-                        os.makedirs(os.path.dirname(target), exist_ok=True)
-                        with z.open(m) as src, open(target,"wb") as dst:
-                            shutil.copyfileobj(src, dst)
-                        tf = db.get(TrackingFile, tracking)
-                        if not tf:
-                            tf = TrackingFile(tracking_no=tracking, file_path=target, uploaded_at=datetime.utcnow()); db.add(tf)
-                        else:
-                            tf.file_path = target; tf.uploaded_at = datetime.utcnow()
-                        saved += 1
-                    except Exception:
-                        skipped += 1
-                    done += 1
-                    if done % 200 == 0:
-                        db.commit()
-                        yield _sse({"phase":"unzip","total": total, "done": done})
-                db.commit()
-
-            # 重建当日 ZIP
-            yield _sse({"phase":"repack","msg":"重建当日归档ZIP…"})
+PDF_IMPORT_CHUNK = 500
+PDF_IMPORT_WORKERS = int(os.environ.get("HUANDAN_PDF_IMPORT_WORKERS", "4") or "4")
+
+def _extract_pdf_members(zip_path: str, items: list, known: dict):
+    """在工作线程中解压一批成员（各线程独立打开 ZIP）。
+    内容哈希与已登记的相同且文件仍在时不写盘；否则写入内容寻址存储并原子替换 PDF_DIR 中的文件。
+    返回 (写入的 [(tracking_no, file_path, sha256)], 未变化数, 失败数)"""
+    ok, same, bad = [], 0, 0
+    with zipfile.ZipFile(zip_path, "r") as z:
+        for member, tracking in items:
+            target = pdf_file_path(tracking)
             try:
-                fp_zip = build_daily_pdf_zip(db, datetime.utcnow().date())
-                if os.path.exists(fp_zip):
-                    # 如果 sidecar 还没有 SHA，尽量写一个
-                    if not _read_sidecar_sha(fp_zip):
-                        try:
-                            h=hashlib.sha256()
-                            with open(fp_zip, "rb") as f:
-                                for chunk in iter(lambda: f.read(1024*1024), b""):
-                                    h.update(chunk)
-                            _write_sidecar_sha(fp_zip, h.hexdigest())
-                        except Exception:
-                            pass
+                data = z.read(member)
+                sha = hashlib.sha256(data).hexdigest()
+                old, old_fp, old_pack = known.get(tracking) or (None, None, None)
+                # 内容未变且文件仍在（旧布局下的也算，留给迁移任务移动；已冷归档的也算）
+                if old == sha and ((old_fp and os.path.exists(old_fp)) or (old_pack and os.path.exists(old_pack))):
+                    same += 1; continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                store_pdf_blob(data, sha, target)
+                if old_fp and old_fp != target: unlink_pdf(old_fp)
+                if old and old != sha: release_pdf_blob(old)
+                ok.append((tracking, target, sha))
             except Exception:
-                pass
+                bad += 1
+    return ok, same, bad
+
+def _known_pdf_hashes(db, trackings: Iterable) -> dict:
+    """运单号 -> (sha256, 登记路径, 冷归档包)"""
+    out = {}
+    for part in _chunks(trackings):
+        for tn, sha, fp, pk in db.execute(select(TrackingFile.tracking_no, TrackingFile.sha256, TrackingFile.file_path,
+                                                 TrackingFile.pack_path).where(TrackingFile.tracking_no.in_(part))):
+            out[tn] = (sha, fp, pk)
+    return out
 
-            set_mapping_version(db); write_mapping_json(db)
+def upsert_tracking_files(db, items: list, now: datetime) -> int:
+    """批量登记 PDF：items 为 (tracking_no, file_path, sha256)；INSERT ... ON CONFLICT DO UPDATE，不提交事务"""
+    if not items: return 0
+    ts = _sqlite_ts(now)
+    conn = db.connection()
+    conn.exec_driver_sql(
+        "INSERT INTO tracking_file (tracking_no, file_path, uploaded_at, sha256) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(tracking_no) DO UPDATE SET file_path=excluded.file_path, uploaded_at=excluded.uploaded_at, sha256=excluded.sha256, "
+        "pack_path=NULL, pack_offset=NULL, pack_length=NULL",
+        [(tn, fp, ts, sha) for tn, fp, sha in items])
+    conn.exec_driver_sql("INSERT INTO mapping_change (kind, key, tracking_no) VALUES ('file', ?, ?)",
+                         [(tn, tn) for tn, _, _ in items])
+    return len(items)
+
+def update_tracking_paths(db, moves: list):
+    """只改登记路径（目录迁移）：不记变更日志、不升级映射版本，内容与 ETag 均不变；不提交事务"""
+    db.connection().exec_driver_sql("UPDATE tracking_file SET file_path = ? WHERE tracking_no = ?",
+                                    [(fp, tn) for tn, fp in moves])
+
+def import_pdfs_iter(db, tmp_zip: str):
+    """PDF 导入（生成器，产出 SSE 进度）：多线程解压 → 分批入库 → 重建当日 ZIP"""
+    saved=0; skipped=0; unchanged=0; written=0
+    with zipfile.ZipFile(tmp_zip, "r") as z:
+        members = [m for m in z.namelist() if (m and not m.endswith("/") and m.lower().endswith(".pdf"))]
+    total = len(members)
+    yield {"phase":"unzip","total": total, "done": 0}
+    # 同名运单只解压最后一个（与逐个覆盖的结果一致），被覆盖的计入 saved
+    latest = {}
+    for m in members:
+        tracking = canon_tracking(os.path.splitext(os.path.basename(m))[0])
+        if not tracking: skipped += 1; continue
+        if tracking in latest: saved += 1
+        latest[tracking] = m
+    items = [(m, tn) for tn, m in latest.items()]
+    done = total - len(items)
+    with ThreadPoolExecutor(max_workers=max(1, PDF_IMPORT_WORKERS)) as pool:
+        futs = [pool.submit(_extract_pdf_members, tmp_zip, part, _known_pdf_hashes(db, [tn for _, tn in part]))
+                for part in _chunks(items, PDF_IMPORT_CHUNK)]
+        for fut in as_completed(futs):
+            ok, same, bad = fut.result()
+            now = datetime.utcnow()
+            upsert_tracking_files(db, ok, now); db.commit()
+            pdf_index_put(ok, now)
+            written += len(ok); unchanged += same
+            saved += len(ok) + same; skipped += bad; done += len(ok) + same + bad
+            yield {"phase":"unzip","total": total, "done": done}
+
+    # 重建当日 ZIP（内容全部未变化时无需重建，也不升级映射版本）
+    if written:
+        yield {"phase":"repack","msg":"重建当日归档ZIP…"}
+        try:
+            build_daily_pdf_zip(db, datetime.utcnow().date(), force=True)
+        except Exception:
+            pass
+        set_mapping_version(db); write_mapping_json(db)
 
-            # 删除临时文件
-            try: os.remove(tmp_zip)
-            except Exception: pass
+    # 删除临时文件
+    try: os.remove(tmp_zip)
+    except Exception: pass
 
-            yield _sse({"phase":"done","saved": saved, "skipped": skipped, "redirect": "/admin/files"})
-        except Exception as e:
-            db.rollback()
-            yield _sse({"phase":"error","msg": f"处理失败：{e}"})
-    return StreamingResponse(_stream(), media_type="text/event-stream", headers={"Cache-Control":"no-cache"})
+    yield {"phase":"done","saved": saved, "skipped": skipped, "unchanged": unchanged, "redirect": "/admin/files"}
+
+# 第二步：SSE 解压→入库→重建当日ZIP
+@app.post("/admin/api/apply-pdf-import")
+def api_apply_pdf_import(request: Request, tmp: str = Form(...), db=Depends(get_db)):
+    """提交 PDF 导入任务；同一临时 ZIP 重复提交返回原任务号"""
+    require_admin(request, db)
+    tmp_zip = _safe_join_uploads(tmp)
+    if not tmp_zip: raise HTTPException(status_code=400, detail="bad tmp")
+    if not os.path.exists(tmp_zip):
+        jid = find_job("pdf_import", {"tmp_zip": tmp_zip})
+        if not jid: raise HTTPException(status_code=404, detail="临时ZIP不存在，请重新上传")
+    else:
+        jid = enqueue_job("pdf_import", {"tmp_zip": tmp_zip}, once=True)
+    return job_submitted(request, jid)
 
 # ------------------ 文件/订单列表与批量操作 ------------------
+LIST_PAGE_SIZE = 100
+_list_count_cache = {}
+
+def _search_where(table, col, q):
+    """q>=3 字符走 trigram 索引，其余（或无 FTS5 时）退回 LIKE"""
+    if not q: return "", {}
+    if _search_fts["enabled"] and len(q) >= 3:
+        return f"t.rowid IN (SELECT rowid FROM {table}_fts WHERE {col} LIKE :q)", {"q": f"%{q}%"}
+    return f"t.{col} LIKE :q", {"q": f"%{q}%"}
+
+def list_count(db, table, col, q):
+    """列表总数按 (表, 关键字, mapping_version) 缓存：数据不变时翻页/刷新不再重复 count(*)"""
+    key = (table, q or "", get_mapping_version(db))
+    if key in _list_count_cache: return _list_count_cache[key]
+    cond, params = _search_where(table, col, q)
+    n = db.execute(text(f"SELECT count(*) FROM {table} t" + (f" WHERE {cond}" if cond else "")), params).scalar() or 0
+    if len(_list_count_cache) > 256: _list_count_cache.clear()
+    _list_count_cache[key] = n
+    return n
+
+def list_page(db, table, col, ts_col, cols, q, after=None, before=None, limit=LIST_PAGE_SIZE):
+    """按 (ts_col, rowid) 倒序的键集分页。游标为 "<ts>|<rowid>"：after 取该行之后的一页（下一页），
+    before 取该行之前的一页（上一页）。返回 (rows, 下一页游标, 上一页游标)，没有更多时对应游标为 None"""
+    cond, params = _search_where(table, col, q)
+    conds = [cond] if cond else []
+    cur, op, order = (after, "<", "DESC") if after else (before, ">", "ASC") if before else (None, "", "DESC")
+    if cur:
+        ts, _, rid = cur.rpartition("|")
+        try: params.update(cts=ts, crid=int(rid)); conds.append(f"(t.{ts_col}, t.rowid) {op} (:cts, :crid)")
+        except ValueError: cur = None
+    if not cur: order = "DESC"
+    sql = (f"SELECT t.rowid AS rid, {', '.join('t.'+c for c in cols)} FROM {table} t"
+           + (" WHERE " + " AND ".join(conds) if conds else "")
+           + f" ORDER BY t.{ts_col} {order}, t.rowid {order} LIMIT :lim")
+    rows = db.execute(text(sql), dict(params, lim=limit + 1)).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if not rows: return rows, None, None
+    key = lambda r: f"{getattr(r, ts_col)}|{r.rid}"
+    if order == "ASC":  # 向前翻页：倒回显示顺序；来处就是下一页
+        rows.reverse()
+        return rows, key(rows[-1]), key(rows[0]) if more else None
+    return rows, key(rows[-1]) if more else None, key(rows[0]) if cur else None
+
 @app.get("/admin/files", response_class=HTMLResponse)
-def list_files(request: Request, q: Optional[str]=None, page: int=1, db=Depends(get_db)):
-    require_admin(request, db); cleanup_expired(db)
-    page_size=100
-    query = db.query(TrackingFile)
-    if q: query = query.filter(TrackingFile.tracking_no.like(f"%{q}%"))
-    total = query.count()
-    rows = query.order_by(TrackingFile.uploaded_at.desc()).offset((page-1)*page_size).limit(page_size).all()
+def list_files(request: Request, q: Optional[str]=None, after: Optional[str]=None, before: Optional[str]=None, page: int=1, db=Depends(get_db)):
+    require_admin(request, db)
+    page_size=LIST_PAGE_SIZE
+    rows, nxt, prv = list_page(db, "tracking_file", "tracking_no", "uploaded_at", ["tracking_no", "file_path", "uploaded_at", "pack_path"], q, after, before)
+    page = max(2, page) if prv else 1  # 页码只随游标翻页累计；没有上一页（或手填 page 无游标）即第一页
+    total = list_count(db, "tracking_file", "tracking_no", q)
     pages = max(1, math.ceil(total/page_size))
-    return templates.TemplateResponse("files.html", {"request": request, "rows": rows, "q": q, "page": page, "pages": pages, "total": total, "page_size": page_size})
+    return templates.TemplateResponse("files.html", {"request": request, "rows": rows, "q": q, "page": page, "pages": pages, "total": total, "page_size": page_size, "next_cursor": nxt, "prev_cursor": prv})
+
+BATCH_DELETE_CHUNK = 5000
+
+def _batch_delete(db, table, key_col, q, kind, cols):
+    """按 rowid 升序分批删除匹配行（集合式 SQL，每批单独提交），逐批产出被删除的行；
+    带条件删除时同步写入变更日志，全部删除由调用方重置日志"""
+    cond, params = _search_where(table, key_col, q)
+    conn = db.connection(); last = 0
+    sql = (f"SELECT t.rowid AS rid, {', '.join('t.'+c for c in cols)} FROM {table} t WHERE t.rowid > :last"
+           + (f" AND {cond}" if cond else "") + " ORDER BY t.rowid LIMIT :lim")
+    while True:
+        rows = conn.execute(text(sql), dict(params, last=last, lim=BATCH_DELETE_CHUNK)).all()
+        if not rows: break
+        if q:
+            conn.exec_driver_sql("INSERT INTO mapping_change (kind, key, tracking_no) VALUES (?, ?, ?)",
+                                 [(kind, getattr(r, key_col), r.tracking_no) for r in rows])
+        conn.exec_driver_sql(f"DELETE FROM {table} WHERE rowid = ?", [(r.rid,) for r in rows])
+        db.commit(); conn = db.connection(); last = rows[-1].rid
+        yield rows
+
+def delete_files_iter(db, q: str):
+    """批量删除 PDF 登记（生成器，产出 SSE 进度）；文件由后台线程删除，全部删除时整体换目录"""
+    total = list_count(db, "tracking_file", "tracking_no", q); done = 0
+    yield {"phase": "delete", "total": total, "done": 0}
+    pending = []
+    for rows in _batch_delete(db, "tracking_file", "tracking_no", q, "file", ["tracking_no", "file_path", "sha256"]):
+        pdf_index_drop([r.tracking_no for r in rows])
+        items = [(r.tracking_no, r.file_path, r.sha256) for r in rows]
+        if q:
+            for it in items: _unlink_queue.put(it)
+        else:
+            pending.extend(items)
+        done += len(rows); total = max(total, done)
+        yield {"phase": "delete", "total": total, "done": done}
+    if pending and not discard_pdf_dirs():
+        for it in pending: _unlink_queue.put(it)
+    if done:
+        set_mapping_version(db)
+        if not q: reset_mapping_changelog(db)
+        write_mapping_json(db)
+    yield {"phase": "done", "count": done, "redirect": "/admin/files"}
+
+def delete_orders_iter(db, q: str):
+    """批量删除订单映射（生成器，产出 SSE 进度）"""
+    total = list_count(db, "order_mapping", "order_id", q); done = 0
+    yield {"phase": "delete", "total": total, "done": 0}
+    for rows in _batch_delete(db, "order_mapping", "order_id", q, "order", ["order_id", "tracking_no"]):
+        done += len(rows); total = max(total, done)
+        yield {"phase": "delete", "total": total, "done": done}
+    if done:
+        set_mapping_version(db)
+        if not q: reset_mapping_changelog(db)
+        write_mapping_json(db)
+    yield {"phase": "done", "count": done, "redirect": "/admin/orders"}
 
 @app.post("/admin/files/batch_delete_all")
 def file_batch_delete_all(request: Request, q: str = Form(""), db=Depends(get_db)):
     require_admin(request, db)
-    targets = db.query(TrackingFile).filter(TrackingFile.tracking_no.like(f"%{q}%")).all() if q else db.query(TrackingFile).all()
-    cnt=0
-    for tf in targets:
-        try:
-            if tf.file_path and os.path.exists(tf.file_path): os.remove(tf.file_path)
-        except Exception: pass
-        db.delete(tf); cnt+=1
-    db.commit()
-    if cnt>0: set_mapping_version(db); write_mapping_json(db)
-    return RedirectResponse(f"/admin/files?ok={cnt}&q={q}", status_code=302)
+    jid = enqueue_job("files_delete", {"q": q})
+    return job_submitted(request, jid)
 
 @app.get("/admin/file/{tracking_no}")
 def admin_file_download(tracking_no: str, request: Request, db=Depends(get_db)):
     require_admin(request, db)
-    def _find(tr):
-        cand = [tr, canon_tracking(tr)]
-        for t in cand:
-            fp = os.path.join(PDF_DIR, f"{t}.pdf")
-            if os.path.exists(fp): return fp
-        tn = f"{tr}.pdf".lower()
-        for name in os.listdir(PDF_DIR):
-            if name.lower()==tn: return os.path.join(PDF_DIR,name)
-        return None
-    fp = _find(tracking_no)
-    if not fp: raise HTTPException(status_code=404, detail="file not found")
-    return FileResponse(fp, media_type="application/pdf", filename=os.path.basename(fp))
+    return pdf_file_response(request, tracking_no, db)
 
 @app.get("/admin/orders", response_class=HTMLResponse)
-def list_orders(request: Request, q: Optional[str]=None, page: int=1, db=Depends(get_db)):
-    require_admin(request, db); cleanup_expired(db)
-    page_size=100
-    query = db.query(OrderMapping)
-    if q: query = query.filter(OrderMapping.order_id.like(f"%{q}%"))
-    total = query.count()
-    rows = query.order_by(OrderMapping.updated_at.desc()).offset((page-1)*page_size).limit(page_size).all()
+def list_orders(request: Request, q: Optional[str]=None, after: Optional[str]=None, before: Optional[str]=None, page: int=1, db=Depends(get_db)):
+    require_admin(request, db)
+    page_size=LIST_PAGE_SIZE
+    rows, nxt, prv = list_page(db, "order_mapping", "order_id", "updated_at", ["order_id", "tracking_no", "updated_at"], q, after, before)
+    page = max(2, page) if prv else 1  # 页码只随游标翻页累计；没有上一页（或手填 page 无游标）即第一页
+    total = list_count(db, "order_mapping", "order_id", q)
     pages = max(1, math.ceil(total/page_size))
-    return templates.TemplateResponse("orders.html", {"request": request, "rows": rows, "q": q, "page": page, "pages": pages, "total": total, "page_size": page_size})
+    return templates.TemplateResponse("orders.html", {"request": request, "rows": rows, "q": q, "page": page, "pages": pages, "total": total, "page_size": page_size, "next_cursor": nxt, "prev_cursor": prv})
 
 @app.post("/admin/orders/batch_delete_all")
 def orders_batch_delete_all(request: Request, q: str = Form(""), db=Depends(get_db)):
     require_admin(request, db)
-    if q: db.query(OrderMapping).filter(OrderMapping.order_id.like(f"%{q}%")).delete()
-    else: db.query(OrderMapping).delete()
-    db.commit(); set_mapping_version(db); write_mapping_json(db)
-    return RedirectResponse(f"/admin/orders?q={q}", status_code=302)
+    jid = enqueue_job("orders_delete", {"q": q})
+    return job_submitted(request, jid)
 
 # ---- 客户端访问码 ----
 @app.get("/admin/clients", response_class=HTMLResponse)
 def clients_page(request: Request, db=Depends(get_db)):
-    require_admin(request, db)
+    require_admin(request, db); flush_last_used()
     rows = db.query(ClientAuth).order_by(ClientAuth.created_at.desc()).all()
     return templates.TemplateResponse("clients.html", {"request": request, "rows": rows})
 
@@ -742,7 +2166,7 @@ def clients_add(request: Request, code6: str = Form(...), description: str = For
     require_admin(request, db)
     if not code6.isdigit() or len(code6)!=6:
         return RedirectResponse("/admin/clients", status_code=302)
-    db.add(ClientAuth(code_plain=code6, description=description, is_active=True)); db.commit()
+    db.add(ClientAuth(code_plain=code6, code_digest=code_digest(code6), description=description, is_active=True)); db.commit()
     return RedirectResponse("/admin/clients", status_code=302)
 
 @app.post("/admin/clients/toggle")
@@ -750,6 +2174,7 @@ def clients_toggle(request: Request, client_id: int = Form(...), db=Depends(get_
     require_admin(request, db)
     c = db.get(ClientAuth, client_id)
     if c: c.is_active = not c.is_active; db.commit()
+    _auth_cache_drop(client_id)
     return RedirectResponse("/admin/clients", status_code=302)
 
 @app.post("/admin/clients/delete")
@@ -757,6 +2182,7 @@ def clients_delete(request: Request, client_id: int = Form(...), db=Depends(get_
     require_admin(request, db)
     c = db.get(ClientAuth, client_id)
     if c: db.delete(c); db.commit()
+    _auth_cache_drop(client_id)
     return RedirectResponse("/admin/clients", status_code=302)
 
 # ---- 设置 ----
@@ -767,6 +2193,7 @@ def settings_page(request: Request, db=Depends(get_db)):
         "request": request,
         "o_days": get_kv(db,'retention_orders_days','30'),
         "f_days": get_kv(db,'retention_files_days','30'),
+        "interval_minutes": get_kv(db,'retention_interval_minutes','60'),
         "server_version": get_kv(db,"server_version","server-20250916b"),
         "client_recommend": get_kv(db,"client_recommend","client-20250916b")
     })
@@ -777,41 +2204,446 @@ def settings_save(request: Request,
                   retention_files_days: str = Form(...),
                   server_version: str = Form(...),
                   client_recommend: str = Form(...),
+                  retention_interval_minutes: str = Form("60"),
                   db=Depends(get_db)):
     require_admin(request, db)
     set_kv(db,"retention_orders_days", retention_orders_days or "30")
     set_kv(db,"retention_files_days", retention_files_days or "30")
     set_kv(db,"server_version", server_version or "server-20250916b")
     set_kv(db,"client_recommend", client_recommend or "client-20250916b")
-    cleanup_expired(db)
+    set_kv(db,"retention_interval_minutes", retention_interval_minutes or "60")
+    _retention_wake.set()  # 保留期可能变化：唤醒后台任务立即执行一次
     return RedirectResponse("/admin", status_code=302)
 
 # ---- 对齐：后台列表 ≡ 磁盘 pdfs/ ----
+# 上次对齐后的目录快照 {文件名: [size, mtime_ns]}：未变化的条目无需再规范化/重算哈希
+PDF_DIR_SNAPSHOT = os.path.join(DATA_DIR, "pdf_dir_snapshot.json")
+
+def _load_dir_snapshot() -> dict:
+    try:
+        with open(PDF_DIR_SNAPSHOT, "r", encoding="utf-8") as f:
+            snap = json.load(f)
+        return snap.get("entries", {}) if snap.get("dir") == PDF_DIR else {}
+    except Exception:
+        return {}
+
+def _save_dir_snapshot(entries: dict):
+    tmp = PDF_DIR_SNAPSHOT + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"dir": PDF_DIR, "entries": entries}, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, PDF_DIR_SNAPSHOT)
+
+def _file_sha256(path: str) -> Optional[str]:
+    h = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(UPLOAD_CHUNK), b""): h.update(block)
+    except OSError:
+        return None
+    return h.hexdigest()
+
+def _scan_pdf_dir(d: str = PDF_DIR, rel: str = "", depth: int = 0):
+    """遍历 PDF_DIR（平铺的旧文件 + 分层子目录），产出 (相对路径, size, mtime_ns)"""
+    with os.scandir(d) as it:
+        for e in it:
+            try:
+                if e.name.endswith(".pdf") and e.is_file():
+                    st = e.stat()
+                    yield rel + e.name, st.st_size, st.st_mtime_ns
+                elif depth < PDF_SHARD_LEVELS and len(e.name) == 2 and e.is_dir(follow_symlinks=False):
+                    yield from _scan_pdf_dir(e.path, rel + e.name + "/", depth + 1)
+            except OSError:
+                continue
+
+def reconcile_iter(db):
+    """对齐 PDF 目录与 TrackingFile（生成器，产出 SSE 进度）。
+    一次目录遍历取得 (相对路径, size, mtime)，与一次批量查询做集合运算；只对相对快照有变化的条目做改名/重算哈希。"""
+    yield {"phase": "scan", "done": 0}
+    entries = {}
+    for rel, size, mtime in _scan_pdf_dir():
+        entries[rel] = [size, mtime]
+        if len(entries) % 20000 == 0: yield {"phase": "scan", "done": len(entries)}
+    snap = _load_dir_snapshot()
+    changed = [n for n, v in entries.items() if snap.get(n) != v]
+    yield {"phase": "scan", "done": len(entries), "changed": len(changed)}
+
+    # 变化条目：文件名规范化（目标已存在则删除重复文件），改名后落到所属分层目录；已是规范名的原地登记
+    renamed = 0; modified = []
+    for name in changed:
+        base = os.path.basename(name)[:-4]
+        cn = canon_tracking(base)
+        if not cn or cn == base:
+            if name in snap: modified.append(name)
+            continue
+        dst_fp = pdf_file_path(cn)
+        dst = os.path.relpath(dst_fp, PDF_DIR).replace(os.sep, "/")
+        try:
+            if dst not in entries:
+                os.makedirs(os.path.dirname(dst_fp), exist_ok=True)
+                os.rename(os.path.join(PDF_DIR, name), dst_fp); entries[dst] = entries[name]; renamed += 1
+            else: os.remove(os.path.join(PDF_DIR, name))
+        except OSError:
+            continue
+        del entries[name]
+
+    rows = {tn: (fp, sha) for tn, fp, sha in db.execute(select(TrackingFile.tracking_no, TrackingFile.file_path, TrackingFile.sha256))}
+    on_disk = {}  # 运单号 -> 相对路径；同一运单新旧布局各有一份时以登记的为准
+    for rel in entries:
+        tn = os.path.basename(rel)[:-4]
+        if tn not in on_disk or os.path.join(PDF_DIR, rel) == (rows.get(tn) or (None,))[0]: on_disk[tn] = rel
+
+    def _missing(tn, fp):
+        if not fp: return True
+        if fp.startswith(PDF_DIR + os.sep): return os.path.relpath(fp, PDF_DIR).replace(os.sep, "/") not in entries
+        return not os.path.exists(fp)
+
+    # 已冷归档的运单不在 PDF_DIR 中，包文件还在即视为存在
+    packs = {}
+    packed = {tn for tn, pk in db.execute(text("SELECT tracking_no, pack_path FROM tracking_file WHERE pack_path IS NOT NULL"))
+              if packs.setdefault(pk, os.path.exists(pk))}
+
+    added = sorted(on_disk.keys() - rows.keys())
+    dropped = [tn for tn, (fp, _) in rows.items() if _missing(tn, fp) and tn not in on_disk and tn not in packed]
+    # 登记路径已不存在但另一布局下有同名文件（迁移中断等）：改登记路径，不算删除
+    moved = [tn for tn, (fp, _) in rows.items() if _missing(tn, fp) and tn in on_disk and tn not in packed]
+    # 已登记但内容被外部替换的文件：重算 sha256，避免 ETag 沿用旧值
+    gone = set(dropped)
+    rehash = [tn for tn in (os.path.basename(n)[:-4] for n in modified) if tn in rows and tn not in gone]
+    total = len(added) + len(dropped) + len(rehash); done = 0
+    yield {"phase": "apply", "total": total, "done": 0}
+
+    now = datetime.utcnow()
+    for part in _chunks(added, BATCH_DELETE_CHUNK):
+        items = [(tn, os.path.join(PDF_DIR, on_disk[tn]), None) for tn in part]
+        upsert_tracking_files(db, items, now); db.commit()
+        pdf_index_put(items, now)
+        done += len(part); yield {"phase": "apply", "total": total, "done": done}
+    for part in _chunks(dropped, BATCH_DELETE_CHUNK):
+        conn = db.connection()
+        conn.exec_driver_sql("INSERT INTO mapping_change (kind, key, tracking_no) VALUES ('file', ?, ?)", [(tn, tn) for tn in part])
+        conn.exec_driver_sql("DELETE FROM tracking_file WHERE tracking_no = ?", [(tn,) for tn in part])
+        db.commit()
+        pdf_index_drop(part)
+        for tn in part: release_pdf_blob(rows[tn][1])
+        done += len(part); yield {"phase": "apply", "total": total, "done": done}
+    # 新内容按新哈希重新存为 blob 并改链接，旧 blob（原地改写时内容已不符）提交后释放
+    for part in _chunks(rehash, 200):
+        ups = []
+        for tn in part:
+            fp, old = rows[tn]
+            try:
+                with open(fp, "rb") as f: data = f.read()
+            except OSError:
+                continue
+            sha = hashlib.sha256(data).hexdigest()
+            if sha == old: continue
+            try: store_pdf_blob(data, sha, fp)
+            except OSError: continue
+            ups.append((sha, tn)); pdf_index_put([(tn, fp, sha)], now)
+            rel = os.path.relpath(fp, PDF_DIR).replace(os.sep, "/")
+            if rel in entries:
+                st = os.stat(fp); entries[rel] = [st.st_size, st.st_mtime_ns]  # 换了 inode，快照随之更新
+        if ups:
+            conn = db.connection()
+            conn.exec_driver_sql("UPDATE tracking_file SET sha256 = ? WHERE tracking_no = ?", ups)
+            conn.exec_driver_sql("INSERT INTO mapping_change (kind, key, tracking_no) VALUES ('file', ?, ?)", [(tn, tn) for _, tn in ups])
+            db.commit()
+            for _, tn in ups: release_pdf_blob(rows[tn][1])
+        done += len(part); yield {"phase": "apply", "total": total, "done": done}
+    for part in _chunks(moved, BATCH_DELETE_CHUNK):
+        moves = [(tn, os.path.join(PDF_DIR, on_disk[tn])) for tn in part]
+        update_tracking_paths(db, moves); db.commit()
+        pdf_index_move(moves)
+
+    if added or dropped or rehash:
+        set_mapping_version(db); write_mapping_json(db)
+    _save_dir_snapshot(entries)
+    yield {"phase": "done", "added": len(added), "renamed": renamed, "dropped": len(dropped), "rehashed": len(rehash), "moved": len(moved),
+           "redirect": f"/admin/files?reconciled=1&added={len(added)}&renamed={renamed}&dropped={len(dropped)}"}
+
+def pdf_shard_migrate_iter(db):
+    """把不在当前布局位置的 PDF 移到 pdf_file_path（生成器，产出 SSE 进度），可在服务运行中执行、中断后重跑。
+    每个文件先在新位置建硬链接、改登记路径并提交，再删除旧链接：任何时刻登记的路径都可读；
+    其他进程内存索引里的旧路径由 find_pdf_entry 回退到新位置。内容不变，不升级映射版本"""
+    total = db.execute(text("SELECT count(*) FROM tracking_file")).scalar() or 0
+    yield {"phase": "migrate", "total": total, "done": 0, "moved": 0}
+    last, done, moved, missing = 0, 0, 0, 0
+    while True:
+        rows = db.execute(text("SELECT rowid, tracking_no, file_path FROM tracking_file WHERE rowid > :r AND pack_path IS NULL ORDER BY rowid LIMIT :n"),
+                          {"r": last, "n": BATCH_DELETE_CHUNK}).all()
+        if not rows: break
+        last = rows[-1][0]; done += len(rows)
+        moves, olds = [], []
+        for _, tn, fp in rows:
+            dst = pdf_file_path(tn)
+            if not fp or fp == dst: continue
+            if not os.path.exists(fp):
+                if os.path.exists(dst): moves.append((tn, dst))
+                else: missing += 1
+                continue
+            try:
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                if os.path.exists(dst): os.remove(dst)
+                try: os.link(fp, dst); olds.append(fp)
+                except OSError: os.rename(fp, dst)  # 不支持硬链接：直接改名
+            except OSError as e:
+                print("pdf migrate warn:", e); continue
+            moves.append((tn, dst))
+        if moves:
+            update_tracking_paths(db, moves); db.commit()
+            pdf_index_move(moves)
+            for fp in olds:
+                try: os.remove(fp)
+                except OSError: pass
+            moved += len(moves)
+        yield {"phase": "migrate", "total": total, "done": done, "moved": moved}
+    yield {"phase": "done", "moved": moved, "missing": missing, "redirect": f"/admin/files?migrated={moved}"}
+
+@app.post("/admin/pdf-migrate")
+def admin_pdf_migrate(request: Request, db=Depends(get_db)):
+    require_admin(request, db)
+    jid = enqueue_job("pdf_migrate", dedupe=True)
+    return job_submitted(request, jid)
+
 @app.post("/admin/reconcile")
 def admin_reconcile(request: Request, db=Depends(get_db)):
     require_admin(request, db)
-    import glob
-    added=renamed=0
-    for fp in glob.glob(os.path.join(PDF_DIR, '*.pdf')):
-        base=os.path.splitext(os.path.basename(fp))[0]
-        cn=canon_tracking(base)
-        dst=os.path.join(PDF_DIR, f"{cn}.pdf")
-        if os.path.abspath(fp)!=os.path.abspath(dst):
-            if not os.path.exists(dst): shutil.move(fp,dst); renamed+=1
-            else: os.remove(fp)
-            fp=dst
-        rec = db.get(TrackingFile, cn)
-        if not rec:
-            db.add(TrackingFile(tracking_no=cn, file_path=fp, uploaded_at=datetime.utcnow()))
-            added+=1
-    db.commit()
-    drop=0
-    for rec in db.query(TrackingFile).all():
-        if not rec.file_path or not os.path.exists(rec.file_path):
-            db.delete(rec); drop+=1
-    db.commit()
-    set_mapping_version(db); write_mapping_json(db)
-    return RedirectResponse(f"/admin/files?reconciled=1&added={added}&renamed={renamed}&dropped={drop}", status_code=302)
+    jid = enqueue_job("reconcile")
+    return job_submitted(request, jid)
+
+# ------------------ 后台任务队列 ------------------
+# 任务记录在 jobs.sqlite3，由分发线程按 JOB_WORKERS 并发领取执行，每个任务使用独立的写会话；
+# 浏览器只负责通过 SSE 查看进度，关闭页面不影响执行，进程重启后中断的任务自动重新排队
+JOB_WORKERS = int(os.environ.get("HUANDAN_JOB_WORKERS", "1") or "1")
+JOB_KEEP_DAYS = int(os.environ.get("HUANDAN_JOB_KEEP_DAYS", "30") or "30")
+JOB_MAX_ATTEMPTS = 3
+
+def _proc_start_token(pid: int) -> str:
+    """开机标识 + 进程启动时刻（取自 /proc）：重启后主机名与进程号被复用也能区分；无 /proc 时为空"""
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as f: boot = f.read().strip()[:8]
+        with open(f"/proc/{pid}/stat") as f: start = f.read().rpartition(")")[2].split()[19]
+        return f"{boot}-{start}"
+    except (OSError, IndexError):
+        return ""
+
+JOB_OWNER = f"{os.uname().nodename}:{os.getpid()}:{_proc_start_token(os.getpid())}"
+JOB_ENQUEUE_LOCK_FILE = os.path.join(DATA_DIR, ".jobs.lock")
+
+JOB_KINDS = {
+    "orders_import": ("订单导入", import_orders_iter),
+    "pdf_import": ("PDF导入", import_pdfs_iter),
+    "files_delete": ("批量删除PDF", delete_files_iter),
+    "orders_delete": ("批量删除订单", delete_orders_iter),
+    "reconcile": ("对齐文件夹", reconcile_iter),
+    "pdf_migrate": ("PDF目录分层迁移", pdf_shard_migrate_iter),
+    "pdf_tier": ("PDF冷归档", pdf_tier_iter),
+    "daily_zip": ("重建归档ZIP", daily_zip_iter),
+    "db_vacuum": ("整理数据库", db_vacuum_iter),
+}
+
+_job_pool = ThreadPoolExecutor(max_workers=max(1, JOB_WORKERS), thread_name_prefix="job")
+_job_wake = threading.Event()
+_job_lock = threading.Lock()
+_job_running = {"n": 0}
+_job_live = {}  # job_id -> (status, 最近事件)：本进程执行过的任务，SSE 直接读内存
+
+def enqueue_job(kind: str, args: Optional[dict] = None, dedupe: bool = False, once: bool = False) -> int:
+    """提交任务并返回任务号。dedupe：已有排队中的同类任务则直接返回其任务号；
+    once：同类型、同参数的任务已提交过（未失败）则返回原任务号，同一份上传重复提交只导入一次"""
+    db = JobSession()
+    body = json.dumps(args or {}, ensure_ascii=False, sort_keys=True)
+    # 查重与插入在同一把文件锁内，多个 worker 的归档线程不会重复排队
+    with file_lock(JOB_ENQUEUE_LOCK_FILE):
+        try:
+            if dedupe:
+                row = db.execute(select(Job.id).where(Job.kind == kind, Job.status == "queued")).first()
+                if row: return row[0]
+            if once:
+                row = db.execute(_same_job(kind, body)).first()
+                if row: return row[0]
+            job = Job(kind=kind, args=body, status="queued", attempts=0)
+            db.add(job); db.commit()
+            job_id = job.id
+        finally:
+            db.close()
+    _job_wake.set()
+    return job_id
+
+def _same_job(kind: str, body: str):
+    return select(Job.id).where(Job.kind == kind, Job.args == body, Job.status != "error").order_by(Job.id.desc())
+
+def find_job(kind: str, args: dict) -> Optional[int]:
+    """同类型、同参数且未失败的最近一个任务号"""
+    db = JobSession()
+    try:
+        row = db.execute(_same_job(kind, json.dumps(args, ensure_ascii=False, sort_keys=True))).first()
+        return row[0] if row else None
+    finally:
+        db.close()
+
+def _job_update(job_id: int, **values):
+    db = JobSession()
+    try:
+        db.execute(Job.__table__.update().where(Job.id == job_id).values(**values)); db.commit()
+    finally:
+        db.close()
+
+def _claim_job() -> Optional[tuple]:
+    """领取最早的排队任务（条件更新，多进程同时领取也只有一个成功）"""
+    db = JobSession()
+    try:
+        for job_id, kind, args in db.execute(select(Job.id, Job.kind, Job.args).where(Job.status == "queued").order_by(Job.id).limit(5)).all():
+            n = db.execute(Job.__table__.update().where(Job.id == job_id, Job.status == "queued").values(
+                status="running", owner=JOB_OWNER, started_at=datetime.utcnow(), attempts=Job.attempts + 1)).rowcount
+            db.commit()
+            if n: return job_id, kind, json.loads(args or "{}")
+        return None
+    finally:
+        db.close()
+
+def _execute_job(job_id: int, kind: str, args: dict):
+    label, fn = JOB_KINDS.get(kind, (kind, None))
+    status, last, err = "error", {}, None
+    _job_live[job_id] = ("running", {"phase": "running", "job_id": job_id})
+    db = WriteSession()
+    try:
+        if fn is None: raise ValueError(f"未知任务类型 {kind}")
+        saved = 0.0
+        for ev in fn(db, **args):
+            last = ev; _job_live[job_id] = ("running", ev)
+            if time.monotonic() - saved >= 1.0:
+                _job_update(job_id, progress=json.dumps(ev, ensure_ascii=False)); saved = time.monotonic()
+        status = "done"
+    except Exception as e:
+        db.rollback()
+        last = {"phase": "error", "msg": f"{label}失败：{e}"}; err = traceback.format_exc()
+    finally:
+        db.close()
+        try:
+            body = json.dumps(last, ensure_ascii=False)
+            _job_update(job_id, status=status, progress=body, result=body, error=err, finished_at=datetime.utcnow())
+        except Exception as e:
+            print("job update warn:", e)
+        _job_live[job_id] = (status, last)
+        if len(_job_live) > 500:
+            for k in sorted(_job_live)[:-100]:
+                if _job_live[k][0] in ("done", "error"): _job_live.pop(k, None)
+        with _job_lock: _job_running["n"] -= 1
+        _job_wake.set()
+
+def _owner_alive(owner: str) -> bool:
+    """owner 对应的进程仍在运行：同一主机、进程存在且启动标识一致（旧格式无标识的只看进程号）"""
+    host, pid, token = ((owner or "").split(":") + ["", ""])[:3]
+    if host != os.uname().nodename or not pid.isdigit(): return False
+    try: os.kill(int(pid), 0)
+    except ProcessLookupError: return False
+    except PermissionError: pass
+    return not token or token == _proc_start_token(int(pid))
+
+def _recover_jobs():
+    """执行者进程已不存在的 running 任务：未超过重试次数则重新排队，否则标记失败。
+    只在启动时调用，此时本进程尚未领取任何任务，记在本进程名下的只能是同名的前一个进程留下的"""
+    db = JobSession()
+    try:
+        for job in db.query(Job).filter(Job.status == "running").all():
+            if job.owner != JOB_OWNER and _owner_alive(job.owner): continue
+            if (job.attempts or 0) < JOB_MAX_ATTEMPTS:
+                job.status = "queued"; job.owner = None
+            else:
+                job.status = "error"; job.finished_at = datetime.utcnow()
+                job.result = json.dumps({"phase": "error", "msg": "任务多次中断，已放弃"}, ensure_ascii=False)
+        db.commit()
+    finally:
+        db.close()
+
+def _prune_jobs():
+    db = JobSession()
+    try:
+        db.query(Job).filter(Job.status.in_(["done", "error"]),
+                             Job.finished_at < datetime.utcnow() - timedelta(days=JOB_KEEP_DAYS)).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+def _job_dispatch_loop():
+    pruned = 0.0
+    while True:
+        _job_wake.wait(5)
+        _job_wake.clear()
+        try:
+            while _job_running["n"] < JOB_WORKERS:
+                claimed = _claim_job()
+                if not claimed: break
+                with _job_lock: _job_running["n"] += 1
+                _job_pool.submit(_execute_job, *claimed)
+            if time.monotonic() - pruned > 3600:
+                _prune_jobs(); pruned = time.monotonic()
+        except Exception as e:
+            print("job dispatch warn:", e)
+
+def _job_state(job_id: int) -> tuple:
+    """(status, 最近事件)；本进程执行的读内存，其余读任务库"""
+    live = _job_live.get(job_id)
+    if live: return live
+    db = JobSession()
+    try:
+        job = db.get(Job, job_id)
+        if not job: return "error", {"phase": "error", "msg": "任务不存在"}
+        if job.status in ("done", "error"): return job.status, json.loads(job.result or "{}")
+        if job.status == "queued": return "queued", {"phase": "queued", "job_id": job_id}
+        return job.status, json.loads(job.progress or "null") or {"phase": "running", "job_id": job_id}
+    finally:
+        db.close()
+
+def job_events(job_id: int) -> StreamingResponse:
+    """以 SSE 推送任务进度直到结束；可随时断开、重新接入"""
+    async def _stream():
+        last = {"phase": "queued", "job_id": job_id}
+        yield _sse(last)
+        while True:
+            status, ev = _job_live.get(job_id) or await run_in_threadpool(_job_state, job_id)
+            if ev != last:
+                yield _sse(ev); last = ev
+            if status not in ("queued", "running"): break
+            await asyncio.sleep(0.3)
+    return StreamingResponse(_stream(), media_type="text/event-stream", headers={"Cache-Control":"no-cache"})
+
+def job_submitted(request: Request, job_id: int):
+    """表单提交后台任务（只走 POST）：页面脚本要 JSON 任务号再接进度 SSE，无脚本时跳到任务页"""
+    if "application/json" in (request.headers.get("accept") or ""):
+        return JSONResponse({"job_id": job_id})
+    return RedirectResponse(f"/admin/jobs?job={job_id}", status_code=302)
+
+@app.get("/admin/api/jobs/{job_id}/events")
+def api_job_events(job_id: int, request: Request, db=Depends(get_db)):
+    require_admin(request, db)
+    return job_events(job_id)
+
+@app.post("/admin/db-vacuum")
+def admin_db_vacuum(request: Request, db=Depends(get_db)):
+    require_admin(request, db)
+    return job_submitted(request, enqueue_job("db_vacuum", dedupe=True))
+
+@app.get("/admin/jobs", response_class=HTMLResponse)
+def jobs_page(request: Request, job: Optional[int] = None, db=Depends(get_db)):
+    require_admin(request, db)
+    jdb = JobSession()
+    try:
+        jobs = jdb.query(Job).order_by(Job.id.desc()).limit(200).all()
+    finally:
+        jdb.close()
+    rows = []
+    for j in jobs:
+        live = _job_live.get(j.id)
+        ev = live[1] if live else json.loads((j.result if j.status in ("done", "error") else j.progress) or "null") or {}
+        end = j.finished_at or (datetime.utcnow() if j.status == "running" else None)
+        rows.append({"id": j.id, "label": JOB_KINDS.get(j.kind, (j.kind,))[0], "status": live[0] if live else j.status,
+                     "created_at": j.created_at, "started_at": j.started_at, "finished_at": j.finished_at,
+                     "seconds": round((end - j.started_at).total_seconds(), 1) if end and j.started_at else None,
+                     "attempts": j.attempts or 0, "event": ev})
+    active = any(r["status"] in ("queued", "running") for r in rows)
+    return templates.TemplateResponse("jobs.html", {"request": request, "rows": rows, "active": active, "focus": job})
 
 # ------------------ ZIP 列表（一级菜单页） ------------------
 @app.get("/admin/zips", response_class=HTMLResponse)
@@ -825,71 +2657,231 @@ def admin_zip_list(request: Request, db=Depends(get_db)):
     return JSONResponse({"rows": rows})
 
 # ------------------ API（客户端使用） ------------------
-@app.get("/api/v1/version")
-def api_version(code: str = Query(""), db=Depends(get_db)):
-    c = verify_code(db, code)
-    if not c: raise HTTPException(status_code=403, detail="invalid code")
-    return JSONResponse({
+def _version_body(db) -> dict:
+    return {
         "version": get_mapping_version(db),
         "list_version": get_mapping_version(db),
         "server_version": get_kv(db,"server_version","server-20250916b"),
         "client_recommend": get_kv(db,"client_recommend","client-20250916b"),
-    })
+    }
 
-@app.get("/api/v1/mapping")
-def api_mapping(code: str = Query(""), db=Depends(get_db)):
+@app.get("/api/v1/version")
+def api_version(code: str = Query(""), db=Depends(get_db)):
     c = verify_code(db, code)
     if not c: raise HTTPException(status_code=403, detail="invalid code")
-    return _build_mapping_payload(db)
+    return JSONResponse(_version_body(db))
+
+# -------- 版本变更推送 --------
+# 客户端保持一条空闲连接等待版本变化，代替定时轮询 /api/v1/version：
+# 每个进程一个协程盯着共享计数 SHM_MAPPING（只读内存，不查库），变化时才回库读版本并唤醒所有等待者；
+# 本进程 set_mapping_version 时直接踢醒该协程，其他 worker 的变更最迟 WATCH_TICK 秒后发现
+WATCH_TICK = 0.25
+WATCH_MAX_TIMEOUT = 60
+WATCH_HEARTBEAT = 15
+_version_watch = {"loop": None, "kick": None, "changed": None, "task": None, "version": "", "gen": -1}
+
+def version_watch_kick():
+    loop = _version_watch["loop"]
+    if loop is None: return
+    try: loop.call_soon_threadsafe(_version_watch["kick"].set)
+    except RuntimeError: pass  # 事件循环已关闭
+
+def _read_version_body(code: Optional[str] = None) -> Optional[dict]:
+    """code 非空时先校验访问码（失败返回 None）；连接只在这一小段内占用"""
+    db = SessionLocal()
+    try:
+        if code is not None and not verify_code(db, code): return None
+        return _version_body(db)
+    finally:
+        db.close()
+
+async def _version_watch_loop():
+    w = _version_watch
+    while True:
+        try: await asyncio.wait_for(w["kick"].wait(), WATCH_TICK)
+        except asyncio.TimeoutError: pass
+        w["kick"].clear()
+        gen = shm_get(SHM_MAPPING)
+        if gen == w["gen"]: continue
+        try: v = (await run_in_threadpool(_read_version_body))["version"]
+        except Exception as e:
+            print("version watch warn:", e); continue
+        w["gen"] = gen
+        if v != w["version"]:
+            w["version"] = v
+            ev, w["changed"] = w["changed"], asyncio.Event()
+            ev.set()
+
+@app.on_event("startup")
+async def _start_version_watch():
+    w = _version_watch
+    w["loop"], w["kick"], w["changed"] = asyncio.get_running_loop(), asyncio.Event(), asyncio.Event()
+    w["task"] = asyncio.create_task(_version_watch_loop())
+
+async def _next_version_body(since: str, timeout: float) -> Optional[dict]:
+    """等到版本不同于 since 后返回新的版本信息；超时返回 None"""
+    deadline = time.monotonic() + timeout
+    while True:
+        left = deadline - time.monotonic()
+        if left <= 0: return None
+        if _version_watch["version"] != since:
+            body = await run_in_threadpool(_read_version_body)
+            if body["version"] != since: return body
+            await asyncio.sleep(min(WATCH_TICK, left)); continue  # 推送协程尚未追上最新版本
+        try: await asyncio.wait_for(_version_watch["changed"].wait(), left)
+        except asyncio.TimeoutError: return None
+
+@app.get("/api/v1/version/watch")
+async def api_version_watch(code: str = Query(""), since: str = Query(""), timeout: int = Query(25)):
+    """长轮询：当前版本与 since 不同则立即返回，否则挂起到版本变化或 timeout 秒（最多 60）后返回当前版本"""
+    body = await run_in_threadpool(_read_version_body, code)
+    if not body: raise HTTPException(status_code=403, detail="invalid code")
+    if since and body["version"] == since:
+        body = await _next_version_body(since, max(1, min(timeout, WATCH_MAX_TIMEOUT))) or body
+    return JSONResponse(body, headers={"Cache-Control": "no-store"})
+
+@app.get("/api/v1/version/events")
+async def api_version_events(code: str = Query(""), since: str = Query("")):
+    """SSE：连上先推送一次当前版本（与 since 相同则跳过），之后每次变化推送一条；空闲时定期发送注释行保活"""
+    body = await run_in_threadpool(_read_version_body, code)
+    if not body: raise HTTPException(status_code=403, detail="invalid code")
+    async def _stream():
+        cur = body
+        if cur["version"] != since: yield _sse(cur)
+        while True:
+            nxt = await _next_version_body(cur["version"], WATCH_HEARTBEAT)
+            if nxt:
+                cur = nxt; yield _sse(cur)
+            else:
+                yield ": ping\n\n"
+    return StreamingResponse(_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
-# 单个PDF下载（大小写不敏感兜底）
+@app.get("/api/v1/mapping")
+def api_mapping(request: Request, code: str = Query(""), since: str = Query(""), db=Depends(get_db)):
+    c = verify_code(db, code)
+    if not c: raise HTTPException(status_code=403, detail="invalid code")
+    etag = f'"{get_mapping_version(db)}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    if since:
+        body = mapping_delta(db, since.strip())
+        if body is not None:
+            headers["X-Mapping-Mode"] = "delta"
+            return Response(content=body, media_type="application/json", headers=headers)
+        headers["X-Mapping-Mode"] = "full"
+    snap = mapping_snapshot(db)
+    headers["ETag"] = f'"{snap["version"]}"'
+    if "gzip" in (request.headers.get("accept-encoding") or "").lower():
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=snap["gzip"], media_type="application/json", headers=headers)
+    return Response(content=snap["body"], media_type="application/json", headers=headers)
+
+# 单个PDF下载（大小写不敏感，走内存索引；支持 ETag / If-Modified-Since / Range）
 @app.get("/api/v1/file/{tracking_no}")
-def api_file(tracking_no: str, code: str = Query(""), db=Depends(get_db)):
+def api_file(tracking_no: str, request: Request, code: str = Query(""), db=Depends(get_db)):
     c = verify_code(db, code)
     if not c: raise HTTPException(status_code=403, detail="invalid code")
-    def _find(tr):
-        cand = [tr, canon_tracking(tr)]
-        for t in cand:
-            fp = os.path.join(PDF_DIR, f"{t}.pdf")
-            if os.path.exists(fp): return fp
-        tn = f"{tr}.pdf".lower()
-        for name in os.listdir(PDF_DIR):
-            if name.lower()==tn: return os.path.join(PDF_DIR,name)
-        return None
-    fp = _find(tracking_no)
-    if not fp: raise HTTPException(status_code=404, detail="file not found")
-    return FileResponse(fp, media_type="application/pdf", filename=os.path.basename(fp))
+    return pdf_file_response(request, tracking_no, db)
+
+# 批量下载：一次请求取回多个 PDF（按运单号列表，或某版本之后变更的全部 PDF），边打包边输出
+BATCH_MAX_TRACKING = 20000
+
+class _ZipStreamBuffer:
+    """供 zipfile 写入的只追加缓冲：每写完一个成员就把已产生的字节交给响应流"""
+    def __init__(self):
+        self.buf = bytearray(); self.pos = 0
+    def write(self, b):
+        self.buf += b; self.pos += len(b)
+        return len(b)
+    def tell(self): return self.pos
+    def seek(self, *args): raise OSError("not seekable")
+    def flush(self): pass
+    def drain(self) -> bytes:
+        out = bytes(self.buf); self.buf.clear()
+        return out
+
+def _files_changed_since(db, since: str) -> list:
+    """某版本之后新增/替换/删除过的运单号；变更日志覆盖不到时按 uploaded_at 兜底。
+    与映射增量相同，超过 DELTA_MAX_CHANGES（且不超过单次批量上限）时返回 409，由客户端改为下载每日归档全量同步"""
+    version = get_mapping_version(db)
+    floor = get_kv(db, "mapping_changelog_floor", "")
+    cap = min(DELTA_MAX_CHANGES, BATCH_MAX_TRACKING)
+    if floor and floor <= since <= version:
+        q = select(MappingChange.key).distinct().where(
+            MappingChange.kind == "file", MappingChange.version > since, MappingChange.version <= version)
+    else:
+        try:
+            since_dt = datetime.strptime(since, "%Y-%m-%dT%H:%M:%SZ")
+        except Exception:
+            raise HTTPException(status_code=400, detail="invalid since")
+        q = select(TrackingFile.tracking_no).where(TrackingFile.uploaded_at >= since_dt)
+    keys = db.execute(q.limit(cap + 1)).scalars().all()
+    if len(keys) > cap:
+        raise HTTPException(status_code=409, detail=f"too many changes since {since} (max {cap}); "
+                                                    "fetch the full set via /api/v1/pdf-zips/daily instead")
+    return sorted({canon_tracking(k) for k in keys if k})
+
+def _stream_pdf_batch(entries: list, missing: list, version: str):
+    buf = _ZipStreamBuffer()
+    files = []
+    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_STORED) as z:
+        for tn, fp, sha in entries:
+            try:
+                if isinstance(fp, tuple): z.writestr(f"{tn}.pdf", read_packed(fp))  # 冷归档
+                else: z.write(fp, f"{tn}.pdf")
+                files.append({"tracking_no": tn, "sha256": sha or "", "size": z.getinfo(f"{tn}.pdf").file_size})
+            except Exception:
+                missing.append(tn)
+            chunk = buf.drain()
+            if chunk: yield chunk
+        z.writestr("manifest.json", json.dumps(
+            {"version": version, "count": len(files), "files": files, "missing": missing},
+            ensure_ascii=False, separators=(",", ":")))
+    yield buf.drain()
+
+def pdf_batch_response(db, tracking_nos: list, since: str = ""):
+    get_mapping_version(db)
+    if since:
+        wanted = _files_changed_since(db, since.strip())
+    else:
+        wanted = [t for t in (str(x).strip() for x in (tracking_nos or [])) if t]
+        if not wanted: raise HTTPException(status_code=400, detail="tracking_nos or since required")
+        if len(wanted) > BATCH_MAX_TRACKING: raise HTTPException(status_code=400, detail=f"too many tracking_nos (max {BATCH_MAX_TRACKING})")
+    entries, missing, seen = [], [], set()
+    for t in wanted:
+        ent = find_pdf_entry(t) or find_pdf_packed(t)
+        if not ent: missing.append(t); continue
+        tn = os.path.splitext(os.path.basename(ent[0]))[0]  # 以登记的运单号命名
+        if tn in seen: continue
+        seen.add(tn); entries.append((tn, ent[3] if len(ent) > 3 else ent[0], ent[1]))
+    version = get_mapping_version(db)
+    # 找到/缺失的数量不放响应头：流式写出期间文件仍可能被删，以末尾 manifest.json 为准
+    headers = {"Content-Disposition": 'attachment; filename="pdfs-batch.zip"', "Cache-Control": "no-store",
+               "X-Mapping-Version": version}
+    return StreamingResponse(_stream_pdf_batch(entries, missing, version), media_type="application/zip", headers=headers)
+
+@app.get("/api/v1/files/batch")
+def api_files_batch_get(code: str = Query(""), since: str = Query(""), tn: str = Query(""), db=Depends(get_db)):
+    """GET 形式：since=<version> 或 tn=运单1,运单2"""
+    c = verify_code(db, code)
+    if not c: raise HTTPException(status_code=403, detail="invalid code")
+    return pdf_batch_response(db, [x for x in tn.split(",") if x], since)
+
+@app.post("/api/v1/files/batch")
+def api_files_batch(code: str = Query(""), payload: dict = Body(...), db=Depends(get_db)):
+    """POST JSON：{"tracking_nos": [...]} 或 {"since": "<version>"}；返回 ZIP_STORED 流，末尾附 manifest.json（含未找到的运单）"""
+    c = verify_code(db, code)
+    if not c: raise HTTPException(status_code=403, detail="invalid code")
+    return pdf_batch_response(db, payload.get("tracking_nos") or [], str(payload.get("since") or ""))
 
 # 列表：已有归档日期
 @app.get("/api/v1/pdf-zips/dates")
 def api_pdf_zip_dates(code: str = Query(""), db=Depends(get_db)):
     c = verify_code(db, code)
     if not c: raise HTTPException(status_code=403, detail="invalid code")
-    dates_db=set()
-    try:
-        rows=db.query(TrackingFile.uploaded_at).all()
-        for (u,) in rows:
-            if not u: continue
-            dstr=u.strftime("%Y-%m-%d")
-            dates_db.add(dstr)
-    except Exception:
-        pass
-    lst=list_pdf_zip_dates()
-    dates_zip={x.get("date") for x in lst}
-    for d in sorted(dates_db):
-        if d not in dates_zip:
-            lst.append({"date": d, "zip_name": f"pdfs-{d.replace('-','')}.zip", "size": 0})
-    try:
-        today=datetime.utcnow().date()
-        if today.strftime("%Y-%m-%d") in dates_db:
-            build_daily_pdf_zip(db, today)
-    except Exception:
-        pass
-    try:
-        lst.sort(key=lambda x: x.get("date",""), reverse=True)
-    except Exception:
-        pass
-    return {"dates": lst}
+    return {"dates": daily_zip_index(db)}
 
 # 下载：某日 ZIP（支持 ETag / If-None-Match；带 X-Checksum-Sha256）
 @app.get("/api/v1/pdf-zips/daily")
@@ -908,22 +2900,24 @@ def api_pdf_zip_daily(request: Request, date: Optional[str] = Query(None), code:
             raise HTTPException(status_code=400, detail="invalid date")
     fp = os.path.join(ZIP_DIR, f"pdfs-{_date_str_compact(d)}.zip")
     if not os.path.exists(fp):
-        try:
-            fp = build_daily_pdf_zip(db, d)
-        except Exception:
-            pass
-    if not os.path.exists(fp):
+        # 当日有文件但尚无归档：交给后台线程构建，请客户端稍后重试
+        entry = _daily_index["by_date"].get(_date_str(d)) if daily_zip_index(db) else None
+        if entry and entry["files"] > 0:
+            _zip_wanted.add(entry["date"]); _zip_builder_wake.set()
+            raise HTTPException(status_code=503, detail="zip is being built", headers={"Retry-After": "5"})
         raise HTTPException(status_code=404, detail="zip not found")
 
-    # 生成弱 ETag（mtime + size）
-    st = os.stat(fp)
-    etag = f'W/"{int(st.st_mtime)}-{st.st_size}"'
-    inm = request.headers.get("if-none-match")
-    if inm and inm.strip() == etag:
+    # 有 SHA256 sidecar 时用强 ETag，否则退回弱 ETag（mtime + size）
+    sha = _read_sidecar_sha(fp)
+    if sha:
+        etag = f'"{sha}"'
+    else:
+        st = os.stat(fp)
+        etag = f'W/"{int(st.st_mtime)}-{st.st_size}"'
+    if _etag_matches(request, etag):
         return PlainTextResponse("", status_code=304, headers={"ETag": etag})
 
     headers = {"ETag": etag}
-    sha = _read_sidecar_sha(fp)
     if sha:
         headers["X-Checksum-Sha256"] = sha
-    return FileResponse(fp, media_type="application/zip", filename=os.path.basename(fp), headers=headers)
+    return send_data_file(fp, "application/zip", headers)
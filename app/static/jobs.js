@@ -0,0 +1,33 @@
+// 后台任务的页面端：以 POST 提交取回任务号，再经 SSE（/admin/api/jobs/{id}/events）跟踪进度。
+// 任务在服务端执行，连接中断只需重新接入同一任务，不要重新提交。
+
+// 提交任务，返回任务号（Promise）
+function postJob(url, body) {
+  return fetch(url, {method: "POST", body, headers: {Accept: "application/json"}})
+    .then(r => r.ok ? r.json() : r.json().catch(() => ({})).then(j => Promise.reject(new Error(j.detail || `提交失败：${r.status}`))))
+    .then(j => j.job_id);
+}
+
+// 跟踪任务进度直到 done/error；连接中断时在 box 之后给出“重新接入”和任务页链接
+function followJob(jobId, onEvent, box) {
+  const es = new EventSource(`/admin/api/jobs/${jobId}/events`);
+  es.onmessage = (e) => {
+    const d = JSON.parse(e.data);
+    if (d.phase === "done" || d.phase === "error") es.close();
+    onEvent(d);
+  };
+  es.onerror = () => {
+    es.close();
+    const p = document.createElement("div");
+    p.className = "helper";
+    p.innerHTML = `进度连接中断，任务 #${jobId} 仍在后台执行：<a href="#">重新接入</a> · <a href="/admin/jobs?job=${jobId}">查看任务</a>`;
+    p.querySelector("a").addEventListener("click", (ev) => { ev.preventDefault(); p.remove(); followJob(jobId, onEvent, box); });
+    box.style.display = "block";
+    box.insertAdjacentElement("afterend", p);
+  };
+}
+
+// 表单提交为后台任务（无 JS 时按原表单提交，服务端跳到任务页）
+function submitJob(form, box, onEvent, onFail) {
+  postJob(form.action, new FormData(form)).then(id => followJob(id, onEvent, box), e => onFail(e.message));
+}
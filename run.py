@@ -2,5 +2,9 @@ import os, uvicorn
 
 host = os.environ.get("HOST", "0.0.0.0")
 port = int(os.environ.get("PORT", "8000"))
+# 多进程：各 worker 通过数据目录下的文件锁与共享计数协作（见 README“多进程部署”）
+workers = int(os.environ.get("WORKERS", "1") or "1")
 
-uvicorn.run("app.main:app", host=host, port=port, reload=False, workers=1)
+# worker 以 spawn 方式启动会重新导入本文件，须放在 __main__ 下
+if __name__ == "__main__":
+    uvicorn.run("app.main:app", host=host, port=port, reload=False, workers=workers)
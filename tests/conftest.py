@@ -0,0 +1,63 @@
+# 测试用的临时部署：本进程直接调用 app.main（不跑启动钩子、不执行后台任务，充当 worker A），
+# 另起一个 uvicorn 进程（worker B）对外服务并执行后台任务；两者共用同一数据目录，测试结束后整体删除
+import os, sys, time, shutil, socket, tempfile, subprocess
+
+import pytest
+import httpx
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+ROOT = tempfile.mkdtemp(prefix="huandan-test-")
+BASE, DATA = os.path.join(ROOT, "base"), os.path.join(ROOT, "data")
+os.makedirs(BASE); os.makedirs(DATA)
+os.symlink(os.path.join(REPO, "app"), os.path.join(BASE, "app"))
+TEST_ENV = {"HUANDAN_BASE": BASE, "HUANDAN_DATA": DATA, "HUANDAN_PDF_COLD_DAYS": "0",
+            "HUANDAN_DELTA_MAX_CHANGES": "50", "HUANDAN_MAPPING_DEBOUNCE": "0"}
+ENV = dict(os.environ, PYTHONPATH=REPO, **TEST_ENV)
+os.environ.update(TEST_ENV)
+sys.path.insert(0, REPO)
+
+import app.main as m  # noqa: E402
+
+ADMIN = {"username": "daddy", "password": "20240314AaA#"}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0)); return s.getsockname()[1]
+
+
+@pytest.fixture(scope="session")
+def worker_b():
+    """另一个 worker：独立的 uvicorn 进程，负责建表并执行后台任务；返回已登录后台的客户端"""
+    port = _free_port()
+    log = open(os.path.join(ROOT, "worker_b.log"), "w")
+    p = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port)],
+                         cwd=REPO, env=ENV, stdout=log, stderr=subprocess.STDOUT)
+    c = httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=60)
+    for _ in range(100):
+        try:
+            if c.get("/admin/login").status_code == 200: break
+        except httpx.TransportError:
+            time.sleep(0.2)
+    else:
+        p.kill(); pytest.fail("worker B did not start")
+    assert c.post("/admin/login", data=ADMIN).status_code in (200, 302)
+    yield c
+    c.close(); p.terminate(); p.wait(10); log.close()
+
+
+@pytest.fixture(scope="session")
+def local(worker_b):
+    """本进程内的客户端（不跑启动钩子）：用于需要改模块设置（monkeypatch）的请求；库表由 worker B 建好"""
+    from fastapi.testclient import TestClient
+    m._ensure_search_index()
+    db = m.SessionLocal()
+    try: m.pdf_index_reload(db)
+    finally: db.close()
+    c = TestClient(m.app)
+    assert c.post("/admin/login", data=ADMIN, follow_redirects=False).status_code == 302
+    return c
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(ROOT, ignore_errors=True)
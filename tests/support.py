@@ -0,0 +1,56 @@
+# 各测试共用的操作：通过 worker B 的后台接口导入、跟踪后台任务，或在本进程落盘登记
+import io, os, json, zipfile, hashlib
+from datetime import datetime
+
+import app.main as m
+
+
+def add_code(b, code: str) -> int:
+    """经 worker B 的后台添加访问码（已存在则直接返回）"""
+    db = m.SessionLocal()
+    try:
+        q = db.query(m.ClientAuth).filter(m.ClientAuth.code_plain == code)
+        if not q.first(): b.post("/admin/clients/add", data={"code6": code, "description": ""})
+        return q.one().id
+    finally:
+        db.close()
+
+
+def follow(b, jid) -> dict:
+    """读完任务的 SSE 进度，返回最后一个事件"""
+    last = b.get(f"/admin/api/jobs/{jid}/events").text.strip().splitlines()[-1]
+    return json.loads(last[len("data: "):])
+
+
+def import_pdfs(b, files: dict):
+    """files 为 运单号 -> 内容；返回 (临时文件名, 任务号)"""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as z:
+        for n, data in files.items(): z.writestr(f"{n}.pdf", data)
+    tmp = b.post("/admin/api/upload-pdf-file", files={"zipfile_upload": ("a.zip", buf.getvalue())}).json()["tmp"]
+    jid = b.post("/admin/api/apply-pdf-import", data={"tmp": tmp}, headers={"Accept": "application/json"}).json()["job_id"]
+    ev = follow(b, jid)
+    assert ev["phase"] == "done", ev
+    return tmp, jid
+
+
+def import_orders(b, rows: list) -> dict:
+    """rows 为 (订单号, 运单号)；经上传、选列、提交三步导入，返回结束事件"""
+    csv = "oid,tn\n" + "".join(f"{o},{t}\n" for o, t in rows)
+    b.post("/admin/upload-orders-step1", files={"file": ("o.csv", csv.encode())})
+    b.post("/admin/upload-orders-step2", data={"order_col": "oid", "tracking_col": "tn"})
+    jid = b.post("/admin/api/orders-apply", headers={"Accept": "application/json"}).json()["job_id"]
+    return follow(b, jid)
+
+
+def store_pdf(db, tn: str, data: bytes, uploaded_at=None):
+    """按导入的方式在本进程落盘并登记（提交但不发布版本）"""
+    fp = m.pdf_file_path(tn); os.makedirs(os.path.dirname(fp), exist_ok=True)
+    sha = hashlib.sha256(data).hexdigest()
+    m.store_pdf_blob(data, sha, fp)
+    m.upsert_tracking_files(db, [(tn, fp, sha)], uploaded_at or datetime.utcnow()); db.commit()
+    return fp, sha
+
+
+def version(b, code: str) -> str:
+    return b.get(f"/api/v1/version?code={code}").json()["version"]
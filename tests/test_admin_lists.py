@@ -0,0 +1,84 @@
+# 后台列表：(时间, rowid) 键集分页的上一页/下一页游标、页码标注，以及 VACUUM 后搜索索引仍然正确
+import re
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+import app.main as m
+from support import follow, store_pdf
+
+COLS = ["order_id", "tracking_no", "updated_at"]
+
+
+def _page(db, **kw):
+    rows, nxt, prv = m.list_page(db, "order_mapping", "order_id", "updated_at", COLS, "LPG-", limit=3, **kw)
+    return [r.order_id for r in rows], nxt, prv
+
+
+def _seed(prefix: str, n: int):
+    db = m.WriteSession()
+    try:
+        t0 = datetime(2021, 3, 1)
+        for i in range(n):  # 逐行不同时间，第 0 行最旧
+            m.upsert_orders(db, pd.DataFrame({"order_id": [f"{prefix}{i}"], "tracking_no": [f"T{prefix}{i}"]}), t0 + timedelta(minutes=i))
+        db.commit()
+    finally:
+        m.set_mapping_version(db)
+        db.close()
+
+
+def test_keyset_paging_forward_and_back(local):
+    _seed("LPG-", 7)
+    db = m.SessionLocal()
+    try:
+        p1, nxt, prv = _page(db)
+        assert p1 == ["LPG-6", "LPG-5", "LPG-4"] and prv is None
+        p2, nxt, prv = _page(db, after=nxt)
+        assert p2 == ["LPG-3", "LPG-2", "LPG-1"] and prv
+        p3, last, prv3 = _page(db, after=nxt)
+        assert p3 == ["LPG-0"] and last is None
+        back, nxt2, prv2 = _page(db, before=prv3)
+        assert back == p2 and nxt2 == nxt
+        first, _, none = _page(db, before=prv2)
+        assert first == p1 and none is None
+        assert m.list_count(db, "order_mapping", "order_id", "LPG-") == 7
+        assert _page(db, after="garbage")[0] == p1  # 坏游标按第一页处理
+    finally:
+        db.close()
+
+
+def test_page_label_follows_cursor(local):
+    _seed("LPL-", 3)
+    html = local.get("/admin/orders", params={"q": "LPL-", "page": 5}).text  # 手填页码、无游标
+    assert "第 1 /" in html and "上一页" not in html
+    db = m.SessionLocal()
+    try:
+        _, nxt, _ = m.list_page(db, "order_mapping", "order_id", "updated_at", COLS, "LPL-", limit=1)
+    finally:
+        db.close()
+    html = local.get("/admin/orders", params={"q": "LPL-", "page": 2, "after": nxt}).text
+    assert "第 2 /" in html and "上一页" in html and "首页" in html
+    assert re.search(r'page=1&(amp;)?before=', html)
+
+
+def test_search_still_correct_after_vacuum(worker_b):
+    _seed("VAC-", 6)
+    jid = worker_b.post("/admin/orders/batch_delete_all", data={"q": "VAC-"}, headers={"Accept": "application/json"}).json()["job_id"]
+    assert follow(worker_b, jid)["count"] == 6
+    _seed("VAK-", 3)
+    jid = worker_b.post("/admin/db-vacuum", headers={"Accept": "application/json"}).json()["job_id"]
+    assert follow(worker_b, jid)["phase"] == "done"
+    db = m.WriteSession()
+    try:
+        store_pdf(db, "VAKF1", b"%PDF-1.4 after vacuum")  # 本进程在 VACUUM 之前打开的连接被换掉，写入照常
+    finally:
+        m.set_mapping_version(db)
+        db.close()
+    db = m.SessionLocal()
+    try:
+        rows, _, _ = m.list_page(db, "order_mapping", "order_id", "updated_at", COLS, "VAK-", limit=10)
+        assert sorted((r.order_id, r.tracking_no) for r in rows) == [(f"VAK-{i}", f"TVAK-{i}") for i in range(3)]
+        assert m.list_page(db, "order_mapping", "order_id", "updated_at", COLS, "VAC-")[0] == []
+        assert [r.tracking_no for r in m.list_page(db, "tracking_file", "tracking_no", "uploaded_at", ["tracking_no"], "VAKF")[0]] == ["VAKF1"]
+    finally:
+        db.close()
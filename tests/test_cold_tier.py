@@ -0,0 +1,84 @@
+# 冷归档：某天的 PDF 转入只读包后删除原文件，下载按偏移读取（含 Range）；重新导入即回到普通文件
+import os
+from datetime import datetime
+
+import app.main as m
+from support import add_code, import_pdfs, store_pdf
+
+DAY = "2020-02-10"
+CODE = "240001"
+
+
+def _at(hour: int) -> datetime:
+    return datetime.fromisoformat(DAY).replace(hour=hour)
+
+
+def _pack(db) -> int:
+    n = m._pack_pdf_day(db, DAY)
+    m.set_mapping_version(db)
+    return n
+
+
+def _pack_of(db, tn: str):
+    return db.execute(m.text("SELECT pack_path FROM tracking_file WHERE tracking_no = :t"), {"t": tn}).scalar()
+
+
+def test_packed_pdf_served_by_offset_with_range(worker_b):
+    add_code(worker_b, CODE)
+    one, two = b"%PDF-1.4 cold one 0123456789", b"%PDF-1.4 cold two"
+    db = m.WriteSession()
+    try:
+        fp1, _ = store_pdf(db, "CT1", one, _at(1)); fp2, _ = store_pdf(db, "CT2", two, _at(2))
+        assert _pack(db) == 2
+        assert not os.path.exists(fp1) and not os.path.exists(fp2)
+        assert _pack_of(db, "CT1") and _pack_of(db, "CT1") == _pack_of(db, "CT2")
+    finally:
+        db.close()
+
+    get = lambda tn, **h: worker_b.get(f"/api/v1/file/{tn}", params={"code": CODE}, headers=h)
+    r = get("ct1")
+    assert r.status_code == 200 and r.content == one and r.headers["Accept-Ranges"] == "bytes"
+    assert get("CT2").content == two
+    r = get("CT1", Range="bytes=9-12")
+    assert r.status_code == 206 and r.content == one[9:13] and r.headers["Content-Range"] == f"bytes 9-12/{len(one)}"
+    assert get("CT1", Range="bytes=-4").content == one[-4:]
+    assert get("CT1", Range=f"bytes={len(one)}-").status_code == 416
+    assert get("CT1", Range="bytes=0-3", **{"If-Range": '"stale"'}).content == one  # If-Range 不符时发整份
+    assert get("CT1", **{"If-None-Match": r.headers["ETag"]}).status_code == 304
+
+
+def test_reimport_unpacks_and_unused_pack_is_removed(worker_b):
+    add_code(worker_b, CODE)
+    db = m.WriteSession()
+    try:
+        store_pdf(db, "CT3", b"%PDF-1.4 three", _at(3))
+        assert _pack(db) == 1
+        pack = _pack_of(db, "CT3")
+    finally:
+        db.close()
+    import_pdfs(worker_b, {"CT3": b"%PDF-1.4 three, again"})
+    assert worker_b.get("/api/v1/file/CT3", params={"code": CODE}).content == b"%PDF-1.4 three, again"
+    db = m.WriteSession()
+    try:
+        assert _pack_of(db, "CT3") is None
+        assert m._gc_pdf_packs(db) >= 1 and not os.path.exists(pack)  # 包内已无在用条目
+    finally:
+        db.close()
+
+
+def test_file_reimported_while_packing_is_kept(worker_b, monkeypatch):
+    db = m.WriteSession()
+    real = m.build_daily_pdf_zip
+    def build_then_reimport(*a, **kw):
+        fp = real(*a, **kw)
+        store_pdf(db, "CT4", b"%PDF-1.4 four, newer", _at(5))  # ZIP 生成之后又导入了新内容
+        return fp
+    try:
+        fp, _ = store_pdf(db, "CT4", b"%PDF-1.4 four", _at(4))
+        monkeypatch.setattr(m, "build_daily_pdf_zip", build_then_reimport)
+        _pack(db)
+        assert _pack_of(db, "CT4") is None
+        with open(fp, "rb") as f: assert f.read() == b"%PDF-1.4 four, newer"
+    finally:
+        m.set_mapping_version(db)
+        db.close()
@@ -0,0 +1,60 @@
+# 每日归档：只有新增时在原 ZIP 后追加，有替换时整包重写；清单与 sha256 旁文件随之更新
+import json, zipfile, hashlib
+from datetime import date, datetime
+
+import app.main as m
+from support import store_pdf
+
+DAY = date(2020, 1, 5)
+
+
+def _at(hour: int) -> datetime:
+    return datetime(DAY.year, DAY.month, DAY.day, hour)
+
+
+def _build(db) -> tuple:
+    fp = m.build_daily_pdf_zip(db, DAY, force=True)
+    with open(fp, "rb") as f: raw = f.read()
+    with zipfile.ZipFile(fp) as z:
+        members = {i.filename: z.read(i) for i in z.infolist()}
+        assert {i.compress_type for i in z.infolist()} == {zipfile.ZIP_STORED}
+        start_dir = z.start_dir
+    with open(fp + ".sha256") as f: assert f.read() == hashlib.sha256(raw).hexdigest()
+    with open(fp + ".manifest.json") as f: manifest = json.load(f)
+    assert manifest["size"] == len(raw) and set(manifest["members"]) == set(members)
+    return raw[:start_dir], members
+
+
+def test_daily_zip_appends_new_files_and_rewrites_on_replace(worker_b):
+    db = m.WriteSession()
+    try:
+        store_pdf(db, "ZD1", b"%PDF-1.4 one", _at(1)); store_pdf(db, "ZD2", b"%PDF-1.4 two", _at(2))
+        data1, members = _build(db)
+        assert members == {"ZD1.pdf": b"%PDF-1.4 one", "ZD2.pdf": b"%PDF-1.4 two"}
+
+        store_pdf(db, "ZD3", b"%PDF-1.4 three", _at(3))
+        data2, members = _build(db)
+        assert data2.startswith(data1)  # 追加：原有成员数据原样保留
+        assert members["ZD3.pdf"] == b"%PDF-1.4 three" and len(members) == 3
+
+        store_pdf(db, "ZD1", b"%PDF-1.4 one, replaced", _at(4))
+        data3, members = _build(db)
+        assert not data3.startswith(data1)  # 替换：整包重写
+        assert members["ZD1.pdf"] == b"%PDF-1.4 one, replaced" and len(members) == 3
+        assert db.execute(m.text("SELECT zip_rev = rev FROM pdf_day WHERE day = :d"), {"d": m._date_str(DAY)}).scalar()
+    finally:
+        m.set_mapping_version(db)
+        db.close()
+
+
+def test_daily_zip_rebuilt_when_manifest_does_not_match(worker_b):
+    db = m.WriteSession()
+    try:
+        store_pdf(db, "ZD4", b"%PDF-1.4 four", _at(5))
+        fp = m.build_daily_pdf_zip(db, DAY, force=True)
+        with open(fp, "ab") as f: f.write(b"junk")  # 例如中途崩溃：清单记录的大小与 ZIP 不符
+        _, members = _build(db)
+        assert "ZD4.pdf" in members
+    finally:
+        m.set_mapping_version(db)
+        db.close()
@@ -0,0 +1,49 @@
+# 后台任务队列：只由 POST 提交、同一上传只入队一次、启动时回收前一个进程遗留的任务
+import os, sys, subprocess
+
+import app.main as m
+from support import follow, import_pdfs
+
+
+def test_destructive_jobs_only_enqueued_by_post(worker_b):
+    # 跨站 GET（SameSite=lax 仍带 Cookie）不得提交删除类任务
+    assert worker_b.get("/admin/api/orders-delete", params={"q": "NO-SUCH"}).status_code == 404
+    r = worker_b.post("/admin/orders/batch_delete_all", data={"q": "NO-SUCH"}, headers={"Accept": "application/json"})
+    assert follow(worker_b, r.json()["job_id"]) == {"phase": "done", "count": 0, "redirect": "/admin/orders"}
+    r = worker_b.post("/admin/orders/batch_delete_all", data={"q": "NO-SUCH"}, follow_redirects=False)
+    assert r.status_code == 302 and r.headers["location"].startswith("/admin/jobs?job=")
+
+
+def test_import_resubmitted_returns_the_same_job(worker_b):
+    # 断线重连或重复点击不会再次导入同一份上传
+    tmp, jid = import_pdfs(worker_b, {"JBI1": b"%PDF-1.4 JBI1"})
+    again = worker_b.post("/admin/api/apply-pdf-import", data={"tmp": tmp}, headers={"Accept": "application/json"})
+    assert again.json()["job_id"] == jid
+    assert worker_b.get("/admin/api/apply-pdf-import", params={"tmp": tmp}).status_code == 405
+    worker_b.post("/admin/upload-orders-step1", files={"file": ("o.csv", b"oid,tn\nJBI-O1,JBI1\n")})
+    worker_b.post("/admin/upload-orders-step2", data={"order_col": "oid", "tracking_col": "tn"})
+    ids = {worker_b.post("/admin/api/orders-apply", headers={"Accept": "application/json"}).json()["job_id"] for _ in range(2)}
+    assert len(ids) == 1 and follow(worker_b, ids.pop())["count"] == 1
+    assert worker_b.post("/admin/api/orders-apply", headers={"Accept": "application/json"}).status_code == 200  # 导入完成后仍可取回
+
+
+def test_recover_jobs_tells_reused_pid_from_live_owner(worker_b):
+    host = os.uname().nodename
+    live = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+    owners = {"reused": f"{host}:{live.pid}:00000000-1",  # 同号进程已换人（重启后 PID 复用）
+              "live": f"{host}:{live.pid}:{m._proc_start_token(live.pid)}",
+              "self": m.JOB_OWNER}                        # 启动时记在本进程名下的只能是前一个同名进程
+    jdb = m.JobSession()
+    try:
+        ids = {}
+        for k, owner in owners.items():
+            job = m.Job(kind="reconcile", args="{}", status="running", owner=owner, attempts=m.JOB_MAX_ATTEMPTS)
+            jdb.add(job); jdb.commit(); ids[k] = job.id
+        m._recover_jobs()
+        jdb.expire_all()
+        status = {k: jdb.get(m.Job, i).status for k, i in ids.items()}
+        for i in ids.values(): jdb.delete(jdb.get(m.Job, i))
+        jdb.commit()
+    finally:
+        jdb.close(); live.kill(); live.wait()
+    assert status == {"reused": "error", "live": "running", "self": "error"}
@@ -0,0 +1,57 @@
+# 映射增量：?since= 只返回其后的变更，日志覆盖不到或变更过多时回退全量；ETag 为版本号，命中返回 304
+from support import add_code, follow, import_orders, version
+
+CODE = "300001"
+
+
+def _mapping(b, **params):
+    return b.get("/api/v1/mapping", params={"code": CODE, **params})
+
+
+def test_delta_lists_upserts_and_deletions(worker_b):
+    add_code(worker_b, CODE)
+    v0 = version(worker_b, CODE)
+    import_orders(worker_b, [("DLO1", " DL T1 "), ("DLDEL1", "DLT2")])
+    r = _mapping(worker_b, since=v0)
+    assert r.status_code == 200 and r.headers["X-Mapping-Mode"] == "delta"
+    d = r.json()
+    assert d["since"] == v0 and d["version"] == version(worker_b, CODE)
+    assert {(u["order_id"], u["tracking_no"]) for u in d["upserts"]} == {("DLO1", "DL_T1"), ("DLDEL1", "DLT2")}
+    assert not [x for x in d["deleted"] if x["order_id"]]  # 只有“无订单文件行”的清除，没有订单被删
+
+    v1 = d["version"]
+    jid = worker_b.post("/admin/orders/batch_delete_all", data={"q": "DLDEL1"}, headers={"Accept": "application/json"}).json()["job_id"]
+    assert follow(worker_b, jid)["count"] == 1
+    d = _mapping(worker_b, since=v1).json()
+    assert d["upserts"] == [] and {"order_id": "DLDEL1", "tracking_no": ""} in d["deleted"]
+
+
+def test_delta_falls_back_to_full(worker_b):
+    add_code(worker_b, CODE)
+    v0 = version(worker_b, CODE)
+    for since in ("2000-01-01T00:00:00Z", "9999-01-01T00:00:00Z", "garbage"):  # 早于日志下限 / 晚于当前版本
+        r = _mapping(worker_b, since=since)
+        assert r.headers["X-Mapping-Mode"] == "full" and "mappings" in r.json()
+    import_orders(worker_b, [(f"DLF{i}", f"DLFT{i}") for i in range(51)])  # 超过 HUANDAN_DELTA_MAX_CHANGES=50
+    r = _mapping(worker_b, since=v0)
+    assert r.headers["X-Mapping-Mode"] == "full"
+    d = r.json()
+    assert d["version"] == version(worker_b, CODE)
+    assert {f"DLF{i}" for i in range(51)} <= {x["order_id"] for x in d["mappings"]}
+
+
+def test_etag_is_version_and_304(worker_b):
+    add_code(worker_b, CODE)
+    r = _mapping(worker_b)
+    etag = r.headers["ETag"]
+    assert etag == f'"{r.json()["version"]}"' and "X-Mapping-Mode" not in r.headers
+    assert _mapping(worker_b, since=r.json()["version"]).headers["X-Mapping-Mode"] == "delta"
+    for inm in (etag, "W/" + etag, f'"other", {etag}'):
+        r304 = worker_b.get("/api/v1/mapping", params={"code": CODE}, headers={"If-None-Match": inm})
+        assert r304.status_code == 304 and r304.headers["ETag"] == etag and r304.content == b""
+    import_orders(worker_b, [("DLE1", "DLET1")])
+    r = worker_b.get("/api/v1/mapping", params={"code": CODE}, headers={"If-None-Match": etag})
+    assert r.status_code == 200 and r.headers["ETag"] != etag
+    assert any(x["order_id"] == "DLE1" for x in r.json()["mappings"])
+    gz = worker_b.get("/api/v1/mapping", params={"code": CODE}, headers={"Accept-Encoding": "gzip"})
+    assert gz.headers["Content-Encoding"] == "gzip" and gz.json() == r.json()
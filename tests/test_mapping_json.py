@@ -0,0 +1,54 @@
+# mapping.json：流式分块编码与全量快照一致，压缩副本与 sha256 旁文件同步更新，去抖时只登记不写盘
+import os, gzip, json, hashlib
+
+import app.main as m
+from support import import_orders
+
+
+def _read(fp: str) -> bytes:
+    with open(fp, "rb") as f: return f.read()
+
+
+def test_mapping_file_matches_snapshot_and_sidecars(worker_b, monkeypatch):
+    import_orders(worker_b, [("MJO1", "MJT1")])
+    assert b'"order_id":"MJO1"' in _read(m.MAPPING_JSON)  # 导入后已写出（测试环境不去抖）
+    monkeypatch.setattr(m, "MAPPING_ENCODE_CHUNK", 2)  # 跨块拼接
+    sha = m.write_mapping_file()
+    body = _read(m.MAPPING_JSON)
+    assert sha == hashlib.sha256(body).hexdigest() == _read(m.MAPPING_JSON + ".sha256").decode()
+    assert gzip.decompress(_read(m.MAPPING_JSON + ".gz")) == body
+    db = m.SessionLocal()
+    try:
+        expected = m._build_mapping_payload(db)
+    finally:
+        db.close()
+    assert body == json.dumps(expected, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    assert not os.path.exists(m.MAPPING_JSON + ".tmp") and not os.path.exists(m.MAPPING_JSON + ".tmp.z")
+
+
+def test_mapping_file_without_compression(worker_b, monkeypatch):
+    m.write_mapping_file()
+    monkeypatch.setattr(m, "MAPPING_COMPRESS", "none")
+    os.remove(m.MAPPING_JSON + ".gz")
+    try:
+        sha = m.write_mapping_file()
+        assert not os.path.exists(m.MAPPING_JSON + ".gz")
+        assert sha == hashlib.sha256(_read(m.MAPPING_JSON)).hexdigest()
+    finally:
+        monkeypatch.undo()
+        m.write_mapping_file()
+
+
+def test_write_request_is_debounced(worker_b, monkeypatch):
+    monkeypatch.setattr(m, "MAPPING_WRITE_DEBOUNCE", 60.0)
+    monkeypatch.setitem(m._mapping_writer, "running", True)
+    monkeypatch.setitem(m._mapping_writer, "first", None)
+    m.write_mapping_file(); os.remove(m.MAPPING_JSON)
+    try:
+        m.write_mapping_json()
+        m.write_mapping_json()
+        assert not os.path.exists(m.MAPPING_JSON) and m._mapping_write_wake.is_set()
+        assert m._mapping_writer["due"] - m._mapping_writer["first"] <= m.MAPPING_WRITE_DEBOUNCE + 1
+    finally:
+        m._mapping_write_wake.clear()
+        m.write_mapping_file()
@@ -0,0 +1,102 @@
+# 多进程部署：本测试进程充当一个 worker（直接调用 app.main），worker B 为另一个 uvicorn 进程，
+# 两者共用同一数据目录，验证共享计数（shm）、文件锁（flock）与跨进程的 PDF 索引同步
+import os, sys, subprocess
+
+import pytest
+
+pytest.importorskip("fcntl")
+
+import app.main as m
+from conftest import ENV, REPO
+from support import add_code, import_pdfs, store_pdf, version
+
+
+def _pending(db) -> int:
+    return db.execute(m.text("SELECT count(*) FROM mapping_change WHERE version IS NULL")).scalar()
+
+
+def test_unpublished_changes_of_other_worker_survive_its_publish(worker_b):
+    add_code(worker_b, "111111")
+    import_pdfs(worker_b, {"MWB0": b"%PDF-1.4 MWB0"})  # B 的索引先就绪
+    assert worker_b.get("/api/v1/file/MWB0?code=111111").status_code == 200
+
+    db = m.WriteSession()
+    try:
+        store_pdf(db, "MWA1", b"%PDF-1.4 from A")            # A 的导入进行中：已提交、未发布
+        import_pdfs(worker_b, {"MWB1": b"%PDF-1.4 MWB1"})   # B 此时发布，版本号同时盖到 A 的变更上
+        assert worker_b.get("/api/v1/file/MWA1?code=111111").status_code == 200
+        m.set_mapping_version(db)                             # A 发布
+    finally:
+        db.close()
+    r = worker_b.get("/api/v1/file/MWA1?code=111111")
+    assert r.status_code == 200 and r.content == b"%PDF-1.4 from A"
+    assert worker_b.get("/api/v1/file/MWB1?code=111111").status_code == 200
+
+
+def test_version_published_by_a_is_seen_by_b(worker_b):
+    add_code(worker_b, "111112")
+    db = m.WriteSession()
+    try:
+        store_pdf(db, "MWA2", b"%PDF-1.4 second")
+        m.set_mapping_version(db)
+        v = m.get_kv(db, "mapping_version")
+    finally:
+        db.close()
+    assert version(worker_b, "111112") == v
+    assert worker_b.get("/api/v1/file/MWA2?code=111112").status_code == 200
+
+
+def test_auth_cache_invalidated_across_workers(worker_b):
+    cid = add_code(worker_b, "222222")
+    assert worker_b.get("/api/v1/version?code=222222").status_code == 200  # B 缓存了该访问码
+    db = m.SessionLocal()
+    try:
+        db.get(m.ClientAuth, cid).is_active = False; db.commit()
+    finally:
+        db.close()
+    m._auth_cache_drop(cid)  # 与后台“停用”相同：A 改库后递增 SHM_AUTH
+    assert worker_b.get("/api/v1/version?code=222222").status_code == 403
+
+
+def test_flock_and_shm_shared_between_processes(worker_b):
+    before = m.shm_get(m.SHM_ZIPS)
+    probe = ("import app.main as m\n"
+             "with m.file_lock(m.RETENTION_LOCK_FILE, blocking=False) as got: print(int(got))\n"
+             "m.shm_add(m.SHM_ZIPS)\n")
+    with m.file_lock(m.RETENTION_LOCK_FILE) as got:
+        assert got
+        out = subprocess.run([sys.executable, "-c", probe], cwd=REPO, env=ENV, capture_output=True, text=True, timeout=60)
+    assert out.returncode == 0, out.stderr
+    assert out.stdout.strip().splitlines()[-1] == "0"  # 锁被本进程持有，另一进程拿不到
+    assert m.shm_get(m.SHM_ZIPS) == before + 1
+
+
+def test_order_import_lets_other_worker_write_between_chunks(worker_b, tmp_path):
+    tmp = tmp_path / "orders.csv"
+    tmp.write_text("oid,tn\n" + "".join(f"MWO{i},MWT{i}\n" for i in range(2 * m.ORDER_IMPORT_CHUNK)))
+    db = m.WriteSession()
+    try:
+        base = _pending(db)
+        it = m.import_orders_iter(db, str(tmp), {"order": "oid", "tracking": "tn"})
+        assert next(it)["phase"] == "read" and next(it)["phase"] == "progress"  # 第一块已提交
+        add_code(worker_b, "444444")  # B 的写入不必等整批导入结束
+        assert _pending(db) == base + m.ORDER_IMPORT_CHUNK  # 尚未发布
+        assert list(it)[-1]["phase"] == "done"
+        assert _pending(db) == 0
+    finally:
+        db.close()
+
+
+def test_auth_lockout_shared_between_workers(worker_b):
+    add_code(worker_b, "333333")
+    db = m.SessionLocal()
+    try:
+        for _ in range(3): assert m.verify_code(db, "000000") is None
+        for _ in range(m.AUTH_MAX_FAILS - 3):
+            assert worker_b.get("/api/v1/version?code=000001").status_code == 403
+        assert worker_b.get("/api/v1/version?code=333333").status_code == 403
+        assert m.verify_code(db, "333333") is None
+    finally:
+        db.close()
+        with m.shm_locked():  # 锁定是全局的，解除后不影响其他测试
+            m.shm_set(m.SHM_AUTH_FAILS, 0); m.shm_set(m.SHM_AUTH_LOCKED, 0)
@@ -0,0 +1,79 @@
+# 文件发送卸载：x-accel / x-sendfile 时应用只做鉴权与 ETag/304，响应体交给前置代理；冷归档中的 PDF 始终直接发送
+import os
+from datetime import date, datetime
+
+import pytest
+
+import app.main as m
+from support import add_code, store_pdf
+
+CODE = "250001"
+DAY = date(2020, 3, 1)
+
+
+@pytest.fixture
+def offload(local, worker_b, monkeypatch):
+    add_code(worker_b, CODE)
+    def use(mode: str):
+        monkeypatch.setattr(m, "FILE_OFFLOAD", mode)
+    return use
+
+
+def _publish(tn: str, data: bytes, at=None) -> str:
+    db = m.WriteSession()
+    try:
+        fp, _ = store_pdf(db, tn, data, at)
+    finally:
+        m.set_mapping_version(db)
+        db.close()
+    return fp
+
+
+def test_pdf_offloaded_to_proxy(local, offload):
+    fp = _publish("OFL1", b"%PDF-1.4 offload")
+    url = f"/api/v1/file/OFL1?code={CODE}"
+    offload("")
+    assert local.get(url).content == b"%PDF-1.4 offload"
+
+    offload("x-accel")
+    r = local.get(url)
+    assert r.status_code == 200 and r.content == b""
+    assert r.headers["X-Accel-Redirect"] == "/_huandan_data/" + os.path.relpath(fp, m.DATA_DIR)
+    assert r.headers["ETag"] and r.headers["Content-Disposition"] == 'attachment; filename="OFL1.pdf"'
+    r304 = local.get(url, headers={"If-None-Match": r.headers["ETag"]})
+    assert r304.status_code == 304 and "X-Accel-Redirect" not in r304.headers
+
+    offload("x-sendfile")
+    r = local.get(url)
+    assert r.headers["X-Sendfile"] == fp and r.content == b""
+
+
+def test_daily_zip_offloaded_with_checksum(local, offload):
+    _publish("OFL2", b"%PDF-1.4 zip member", datetime(DAY.year, DAY.month, DAY.day, 1))
+    db = m.WriteSession()
+    try:
+        fp = m.build_daily_pdf_zip(db, DAY, force=True)
+    finally:
+        db.close()
+    sha = m._read_sidecar_sha(fp)
+    offload("x-accel")
+    r = local.get("/api/v1/pdf-zips/daily", params={"date": DAY.isoformat(), "code": CODE})
+    assert r.status_code == 200 and r.content == b""
+    assert r.headers["X-Accel-Redirect"] == "/_huandan_data/" + os.path.relpath(fp, m.DATA_DIR)
+    assert r.headers["X-Checksum-Sha256"] == sha and r.headers["ETag"] == f'"{sha}"'
+    r304 = local.get("/api/v1/pdf-zips/daily", params={"date": DAY.isoformat(), "code": CODE}, headers={"If-None-Match": f'"{sha}"'})
+    assert r304.status_code == 304 and "X-Accel-Redirect" not in r304.headers
+
+
+def test_packed_pdf_is_never_offloaded(local, offload):
+    at = datetime(DAY.year, DAY.month, DAY.day, 2)
+    _publish("OFL3", b"%PDF-1.4 packed", at)
+    db = m.WriteSession()
+    try:
+        assert m._pack_pdf_day(db, DAY.isoformat()) >= 1
+    finally:
+        m.set_mapping_version(db)
+        db.close()
+    offload("x-accel")
+    r = local.get(f"/api/v1/file/OFL3?code={CODE}")
+    assert r.content == b"%PDF-1.4 packed" and "X-Accel-Redirect" not in r.headers
@@ -0,0 +1,57 @@
+# 订单导入：向量化规范化与批量写入（同一订单以最后一行为准），分块提交，中途失败时已提交的块照常发布
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+import app.main as m
+
+
+def test_failed_order_import_publishes_committed_chunks(worker_b, tmp_path, monkeypatch):
+    tmp = tmp_path / "orders-fail.csv"
+    tmp.write_text("oid,tn\n" + "".join(f"OIF{i},OIG{i}\n" for i in range(2 * m.ORDER_IMPORT_CHUNK)))
+    real, calls = m.normalize_order_frame, []
+    def flaky(*a):
+        calls.append(1)
+        if len(calls) == 2: raise ValueError("broken chunk")
+        return real(*a)
+    monkeypatch.setattr(m, "normalize_order_frame", flaky)
+    db = m.WriteSession()
+    try:
+        before = m.get_kv(db, "mapping_version")
+        with pytest.raises(ValueError):
+            list(m.import_orders_iter(db, str(tmp), {"order": "oid", "tracking": "tn"}))
+        assert m.get_kv(db, "mapping_version") != before
+        assert db.execute(m.text("SELECT count(*) FROM mapping_change WHERE version IS NULL")).scalar() == 0
+        assert db.execute(m.text("SELECT count(*) FROM order_mapping WHERE order_id LIKE 'OIF%'")).scalar() == m.ORDER_IMPORT_CHUNK
+    finally:
+        db.close()
+
+
+def test_canon_tracking_series_matches_scalar():
+    raw = [" ab 12 ", "__x..y__", "中文123", None, "a//b--c", "._", "Z" * 200, 12345]
+    assert m.canon_tracking_series(pd.Series(raw)).tolist() == [m.canon_tracking("" if x is None else str(x)) for x in raw]
+
+
+def test_normalize_order_frame_drops_blank_rows():
+    df = pd.DataFrame({"oid": [" O1 ", "", "O3", None], "tn": ["t 1", "T2", "  ", "T4"]})
+    assert m.normalize_order_frame(df, "oid", "tn").values.tolist() == [["O1", "t_1"]]
+
+
+def test_upsert_orders_last_row_wins_and_logs_old_tracking(worker_b):
+    db = m.WriteSession()
+    try:
+        m.upsert_orders(db, pd.DataFrame({"order_id": ["UPO1", "UPO2"], "tracking_no": ["UPA", "UPB"]}), datetime.utcnow())
+        db.commit()
+        start = db.execute(m.text("SELECT MAX(rowid) FROM mapping_change")).scalar()
+        n = m.upsert_orders(db, pd.DataFrame({"order_id": ["UPO1", "UPO1", "UPO2"], "tracking_no": ["UPX", "UPC", "UPB"]}), datetime.utcnow())
+        db.commit()
+        assert n == 2
+        rows = dict(db.execute(m.text("SELECT order_id, tracking_no FROM order_mapping WHERE order_id LIKE 'UPO%'")).all())
+        assert rows == {"UPO1": "UPC", "UPO2": "UPB"}
+        log = db.execute(m.text("SELECT key, tracking_no FROM mapping_change WHERE rowid > :i ORDER BY rowid"), {"i": start}).all()
+        # 换了运单号的订单同时记下旧运单号，增量里才能清掉旧运单的文件行
+        assert sorted(log) == [("UPO1", "UPA"), ("UPO1", "UPC"), ("UPO2", "UPB")]
+    finally:
+        m.set_mapping_version(db)
+        db.close()
@@ -0,0 +1,26 @@
+# 目录对账：被原地改写的文件重新计算摘要，并与改坏的 blob 脱钩
+import os, hashlib
+
+import app.main as m
+from support import store_pdf
+
+
+def test_reconcile_restores_blob_of_file_edited_in_place(worker_b):
+    old_data, new_data = b"%PDF-1.4 original", b"%PDF-1.4 edited!!"
+    old_sha, new_sha = (hashlib.sha256(d).hexdigest() for d in (old_data, new_data))
+    db = m.WriteSession()
+    try:
+        store_pdf(db, "RCR1", old_data)
+        list(m.reconcile_iter(db))  # 建立目录快照
+        fp = m.pdf_file_path("RCR1")
+        with open(fp, "r+b") as f: f.write(new_data)  # 原地改写：与之共享 inode 的 blob 也被改了
+        assert list(m.reconcile_iter(db))[-1]["rehashed"] == 1
+        assert db.execute(m.text("SELECT sha256 FROM tracking_file WHERE tracking_no = 'RCR1'")).scalar() == new_sha
+        assert os.path.samefile(fp, m.pdf_blob_path(new_sha))
+        assert not os.path.exists(m.pdf_blob_path(old_sha))
+        # 原内容再次导入时不会复用内容已不符的 blob
+        store_pdf(db, "RCR2", old_data)
+        with open(m.pdf_file_path("RCR2"), "rb") as f: assert f.read() == old_data
+    finally:
+        m.set_mapping_version(db)
+        db.close()